@@ -0,0 +1,217 @@
+import argparse
+import copy
+import logging
+import time
+
+import numpy as np
+import torch
+import simplecv as sc
+from simplecv.api.preprocess import comm
+from simplecv.api.preprocess import segm
+from data.isaid import COLOR_MAP
+from data.isaid import ImageFolderDataset
+from module import farseg
+from infer.benchmark import layout_fallbacks
+from infer.benchmark import sample_windows
+from infer.benchmark import time_forward
+from infer.compiled import CompiledModel
+from infer.metric import ConfusionMatrix
+from infer.quant import load_quantized
+from infer.sliding_win import SegmSlidingWinInference
+from infer.stitch import build_accumulator
+from infer.tta import TTAModel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', default=None, type=str,
+                    help='path to config file')
+parser.add_argument('--ckpt_path', default=None, type=str,
+                    help='path to model file')
+parser.add_argument('--image_dir', default=None, type=str,
+                    help='path to image dir, windows are sampled from these scenes')
+parser.add_argument('--mask_dir', default=None, type=str,
+                    help='path to mask dir, if given the mIoU over the windows is reported as well')
+parser.add_argument('--mode', default='early_exit', type=str,
+                    choices=('early_exit', 'tta', 'shared_backbone', 'deploy', 'int8', 'channels_last',
+                             'compile'),
+                    help='inference path compared against the full model')
+parser.add_argument('--num_windows', default=64, type=int,
+                    help='number of windows to time')
+parser.add_argument('--batch_size', default=4, type=int,
+                    help='windows per forward')
+parser.add_argument('--patch_size', default=896, type=int,
+                    help='patch size')
+parser.add_argument('--early_exit', default=0.5, type=float,
+                    help='objectness threshold of the early exit')
+parser.add_argument('--tta_sets', default='flip,flips,rot,d4', type=str,
+                    help='comma separated sets of infer.tta.TTA_SETS to compare')
+parser.add_argument('--shared_tile', default=2048, type=int,
+                    help='tile size of the shared backbone inference')
+parser.add_argument('--shared_halo', default=128, type=int,
+                    help='context around the windows of a shared tile')
+parser.add_argument('--quantized', default=None, type=str,
+                    help='int8 model from quantize.py, compared on the cpu against the fp32 model')
+parser.add_argument('--compile_cache_dir', default=None, type=str,
+                    help='compile cache of the compile mode, a second run shows the warm start')
+parser.add_argument('--num_scenes', default=4, type=int,
+                    help='number of scenes of the scene level modes')
+args = parser.parse_args()
+
+logger = logging.getLogger('SW-Infer')
+logger.setLevel(logging.INFO)
+
+
+def class_ious(labels, masks):
+    miou_op = ConfusionMatrix(num_classes=len(COLOR_MAP))
+    for y_pred, y_true in zip(labels, masks):
+        miou_op.forward(y_true, y_pred)
+    return miou_op.ious()
+
+
+def window_miou(labels, masks):
+    if masks[0] is None:
+        return None
+    return np.nanmean(class_ious(labels, masks))
+
+
+def compare(name, ref_labels, ref_time, labels, elapsed, masks):
+    """ log speed and label agreement of an inference path against the full model.
+    """
+    agreement = (labels == ref_labels).float().mean().item()
+    msg = '{}: {:.2f} ms / window vs {:.2f} ms / window ({:.2f}x), label agreement = {:.4%}'.format(
+        name, elapsed * 1e3, ref_time * 1e3, ref_time / max(elapsed, 1e-9), agreement)
+    miou = window_miou(labels, masks)
+    if miou is not None:
+        msg += ', window mIoU = {:.5f} vs {:.5f}'.format(miou, window_miou(ref_labels, masks))
+    logger.info(msg)
+
+
+def shared_backbone(model, dataset, image_trans, device):
+    """ whole scenes with the encoder shared by the windows of a tile against the encoder run per window,
+    both on the same 32-aligned windows.
+    """
+    helper = SegmSlidingWinInference(batch_size=args.batch_size, shared_tile=args.shared_tile,
+                                     shared_halo=args.shared_halo)
+    helper.device = device
+    helper.transforms = image_trans
+    ref_miou_op = ConfusionMatrix(num_classes=len(COLOR_MAP))
+    miou_op = ConfusionMatrix(num_classes=len(COLOR_MAP))
+    agree, pixels, ref_time, elapsed = 0, 0, 0., 0.
+    for idx in range(min(args.num_scenes, len(dataset))):
+        image, mask, filename = dataset[idx]
+        h, w = image.shape[:2]
+        wins = helper.make_wins((h, w), patch_size=(args.patch_size, args.patch_size), stride=512)
+        scene = helper.prepare_scene(image)
+        outs = []
+        for iter_outputs in (helper.iter_outputs, helper.iter_outputs_shared):
+            acc = build_accumulator('float32', h, w, wins)
+            for pred, win in iter_outputs(model, scene, wins, size_divisor=32):
+                acc.add(pred, win)
+            outs.append((acc.labels(), helper.stats['elapsed']))
+        (ref_labels, ref_elapsed), (labels, shared_elapsed) = outs
+        logger.info('{}: {} windows in {} tiles, encoder amplification = {:.2f}x vs {:.2f}x, '
+                    'label agreement = {:.4%}'.format(filename, len(wins), helper.stats['num_tiles'],
+                                                      helper.stats['encoder_amplification'],
+                                                      helper.stats['amplification'],
+                                                      (labels == ref_labels).float().mean().item()))
+        agree += int((labels == ref_labels).sum())
+        pixels += labels.numel()
+        ref_time += ref_elapsed
+        elapsed += shared_elapsed
+        if mask is not None:
+            ref_miou_op.forward(mask, ref_labels)
+            miou_op.forward(mask, labels)
+    msg = 'shared backbone: {:.2f}s vs {:.2f}s ({:.2f}x), label agreement = {:.4%}'.format(
+        elapsed, ref_time, ref_time / max(elapsed, 1e-9), agree / max(pixels, 1))
+    if args.mask_dir is not None:
+        msg += ', mIoU = {:.5f} vs {:.5f}'.format(np.nanmean(miou_op.ious()), np.nanmean(ref_miou_op.ious()))
+    logger.info(msg)
+
+
+def run():
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    if args.mode == 'int8':
+        # int8 kernels run on the cpu only, the fp32 reference runs there as well
+        device = torch.device('cpu')
+    model, _ = sc.infer_tool.build_and_load_from_file(args.config_path, args.ckpt_path)
+    model.to(device)
+    model.eval()
+    image_trans = comm.Compose([
+        segm.ToTensor(True),
+        comm.THMeanStdNormalize((123.675, 116.28, 103.53), (58.395, 57.12, 57.375)),
+        comm.CustomOp(lambda x: x.unsqueeze(0))
+    ])
+    dataset = ImageFolderDataset(image_dir=args.image_dir, mask_dir=args.mask_dir)
+    if args.mode == 'shared_backbone':
+        shared_backbone(model, dataset, image_trans, device)
+        return
+    windows, masks = sample_windows(dataset, image_trans, args.num_windows, args.patch_size)
+    logger.info('{} windows of {}x{}'.format(len(windows), args.patch_size, args.patch_size))
+
+    ref_labels, ref_time = time_forward(model, windows, args.batch_size, device)
+
+    if args.mode == 'early_exit':
+        model.set_early_exit(args.early_exit)
+        model.reset_exit_stats()
+        labels, elapsed = time_forward(model, windows, args.batch_size, device, num_warmup=0)
+        stats = model.exit_stats
+        logger.info('early exit: {} / {} windows exited at threshold {}, max objectness histogram = {}'.format(
+            stats['exited'], stats['windows'], args.early_exit, stats['max_objectness_hist']))
+        model.set_early_exit(None)
+        compare('early exit', ref_labels, ref_time, labels, elapsed, masks)
+
+    if args.mode == 'deploy':
+        # 折叠BN、合并1x1卷积、去掉dropout后的模型
+        deploy_model = copy.deepcopy(model).to_deploy()
+        labels, elapsed = time_forward(deploy_model, windows, args.batch_size, device)
+        with torch.no_grad():
+            images = torch.cat(windows[:args.batch_size], dim=0).to(device)
+            max_diff = (deploy_model(images) - model(images)).abs().max().item()
+        logger.info('deploy: max probability difference = {:.3e}'.format(max_diff))
+        compare('deploy', ref_labels, ref_time, labels, elapsed, masks)
+
+    if args.mode == 'int8':
+        qmodel, meta = load_quantized(args.quantized)
+        if meta['output_stride'] != 1:
+            raise ValueError('compare a model quantized with output stride 1, got {}.'.format(meta['output_stride']))
+        labels, elapsed = time_forward(qmodel, windows, args.batch_size, device)
+        compare('int8', ref_labels, ref_time, labels, elapsed, masks)
+        if masks[0] is not None:
+            ref_ious, ious = class_ious(ref_labels, masks), class_ious(labels, masks)
+            for name, ref_iou, iou in zip(COLOR_MAP, ref_ious, ious):
+                logger.info('{:<20s} fp32 IoU = {:.5f}, int8 IoU = {:.5f}, delta = {:+.5f}'.format(
+                    name, ref_iou, iou, iou - ref_iou))
+
+    if args.mode == 'channels_last':
+        # 权重和输入都转换为NHWC，并检查哪些模块的输出退回了NCHW
+        cl_model = copy.deepcopy(model).set_memory_format(torch.channels_last)
+        fallbacks = layout_fallbacks(cl_model, windows[0].to(device))
+        logger.info('channels last: {} modules fall back to NCHW{}'.format(
+            len(fallbacks), '' if not fallbacks else ': ' + ', '.join(fallbacks)))
+        labels, elapsed = time_forward(cl_model, windows, args.batch_size, device,
+                                       prepare=lambda x: x.contiguous(memory_format=torch.channels_last))
+        compare('channels last', ref_labels, ref_time, labels, elapsed, masks)
+
+    if args.mode == 'compile':
+        # 第一次前向包含编译时间，单独计时；之后与未编译的模型比较
+        compiled = CompiledModel(model, cache_dir=args.compile_cache_dir)
+        images = torch.cat(windows[:args.batch_size], dim=0).to(device)
+        since = time.perf_counter()
+        with torch.no_grad():
+            compiled(images)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        logger.info('compile: first forward took {:.2f}s'.format(time.perf_counter() - since))
+        labels, elapsed = time_forward(compiled, windows, args.batch_size, device)
+        compiled.save_cache()
+        compare('compile', ref_labels, ref_time, labels, elapsed, masks)
+
+    if args.mode == 'tta':
+        # 每组增强的副本叠成一个batch，与不增强的结果比较速度和精度
+        for tta in args.tta_sets.split(','):
+            labels, elapsed = time_forward(TTAModel(model, tta), windows, args.batch_size, device)
+            compare('tta {}'.format(tta), ref_labels, ref_time, labels, elapsed, masks)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -155,7 +155,8 @@ class ISAIDSegmmDataLoader(DataLoader):
 
 class ImageFolderDataset(Dataset):
     def __init__(self, image_dir, mask_dir=None):
-        self.fp_list = glob.glob(os.path.join(image_dir, '*.png'))
+        # 排序后各评估进程中的场景下标一致
+        self.fp_list = sorted(glob.glob(os.path.join(image_dir, '*.png')))
         self.mask_dir = mask_dir
         self.rm_color = RemoveColorMap()
 
@@ -173,5 +174,11 @@ class ImageFolderDataset(Dataset):
             image_np = np.stack([image_np] * 3, axis=2)
         return image_np, mask_np, os.path.basename(self.fp_list[idx])
 
+    def image_size(self, idx):
+        # 只读取文件头获得图像大小 (H, W)，不解码像素
+        with Image.open(self.fp_list[idx]) as image:
+            w, h = image.size
+        return h, w
+
     def __len__(self):
         return len(self.fp_list)
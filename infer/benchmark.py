@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+import torch
+from simplecv.data.preprocess import sliding_window
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def sample_windows(dataset, transforms, num_windows, patch_size=896, stride=512):
+    """ normalized full size windows from the scenes of an ImageFolderDataset, in dataset order.
+
+    Returns:
+        list of [1, C, patch_size, patch_size] tensors,
+            list of [patch_size, patch_size] uint8 masks (None without a mask dir)
+    """
+    windows, masks = [], []
+    for idx in range(len(dataset)):
+        image, mask, _ = dataset[idx]
+        h, w = image.shape[:2]
+        if h < patch_size or w < patch_size:
+            continue
+        scene = transforms(image.astype(np.float32))
+        for x1, y1, x2, y2 in sliding_window((h, w), (patch_size, patch_size), stride):
+            windows.append(scene[:, :, y1:y2, x1:x2].clone())
+            masks.append(None if mask is None else mask[y1:y2, x1:x2].copy())
+            if len(windows) == num_windows:
+                return windows, masks
+    return windows, masks
+
+
+def time_forward(model, windows, batch_size, device, num_warmup=2, prepare=None):
+    """ forward the windows in batches and time it.
+
+    Args:
+        windows: list of [1, C, h, w] tensors of the same size
+        prepare: optional fn applied to each batch on the device, e.g. a dtype or memory format change
+
+    Returns:
+        [N, h, w] uint8 labels on the host, seconds per window
+    """
+    batches = [torch.cat(windows[i:i + batch_size], dim=0) for i in range(0, len(windows), batch_size)]
+    with torch.no_grad():
+        for images in batches[:num_warmup]:
+            images = images.to(device)
+            model(images if prepare is None else prepare(images))
+        _synchronize(device)
+        outs = []
+        elapsed = 0.
+        for images in batches:
+            images = images.to(device)
+            if prepare is not None:
+                images = prepare(images)
+            _synchronize(device)
+            since = time.perf_counter()
+            out = model(images)
+            _synchronize(device)
+            elapsed += time.perf_counter() - since
+            outs.append(out.argmax(dim=1).to(torch.uint8).cpu())
+    return torch.cat(outs, dim=0), elapsed / max(len(windows), 1)
+
+
+def _tensors(x):
+    if isinstance(x, torch.Tensor):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [t for v in x for t in _tensors(v)]
+    return []
+
+
+def layout_fallbacks(model, images, memory_format=torch.channels_last):
+    """ submodules that get every 4-D input in memory_format but return a 4-D output in another layout.
+
+    The model itself is not checked, its output is the probability map.
+
+    Returns:
+        list of module names
+    """
+    fallbacks = []
+
+    def hook(name):
+        def _check(module, inputs, outputs):
+            ins = [t for t in _tensors(inputs) if t.dim() == 4]
+            outs = [t for t in _tensors(outputs) if t.dim() == 4]
+            if ins and all(t.is_contiguous(memory_format=memory_format) for t in ins) and \
+                    any(not t.is_contiguous(memory_format=memory_format) for t in outs):
+                fallbacks.append(name)
+        return _check
+
+    handles = [m.register_forward_hook(hook(name)) for name, m in model.named_modules() if name]
+    try:
+        with torch.no_grad():
+            model(images.contiguous(memory_format=memory_format))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return fallbacks
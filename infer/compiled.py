@@ -0,0 +1,77 @@
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger('SW-Infer')
+
+ARTIFACTS_NAME = 'artifacts.bin'
+
+
+class CompiledModel(nn.Module):
+    """ torch.compile of a model for sliding window inference, specialized to the window shape.
+
+    The graph is compiled with static shapes except for the batch dimension, so the full batches and the
+    smaller last batch of a scene share one graph per window size, a batch of a single window gets its own.
+    The inductor cache and the compile artifacts are kept in cache_dir, later runs load them and skip
+    most of the compile time.
+    """
+
+    def __init__(self, model, cache_dir=None, mode=None, recompile_limit=16):
+        """
+
+        Args:
+            model: model in eval mode, on its device and with the inference settings already applied
+            cache_dir: directory of the compile cache, kept across runs, None for the default inductor cache
+            mode: mode of torch.compile, e.g. 'max-autotune'
+            recompile_limit: graphs per code object before dynamo falls back to eager, one per window shape
+        """
+        super(CompiledModel, self).__init__()
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(cache_dir, 'inductor')
+            self._load_cache()
+        torch._inductor.config.fx_graph_cache = True
+        if hasattr(torch._dynamo.config, 'recompile_limit'):
+            torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, recompile_limit)
+        else:
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, recompile_limit)
+        self.model = model
+        self.compiled = torch.compile(model, dynamic=False, mode=mode)
+
+    def forward(self, x):
+        torch._dynamo.maybe_mark_dynamic(x, 0)
+        return self.compiled(x)
+
+    def _load_cache(self):
+        path = os.path.join(self.cache_dir, ARTIFACTS_NAME)
+        if not os.path.exists(path) or not hasattr(torch.compiler, 'load_cache_artifacts'):
+            return
+        with open(path, 'rb') as f:
+            torch.compiler.load_cache_artifacts(f.read())
+        logger.info('compile cache loaded from {}'.format(path))
+
+    def save_cache(self):
+        """ write the artifacts of the graphs compiled so far to cache_dir.
+        """
+        if self.cache_dir is None or not hasattr(torch.compiler, 'save_cache_artifacts'):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return
+        path = os.path.join(self.cache_dir, ARTIFACTS_NAME)
+        # the evaluation processes of --num_procs share the cache dir, the last complete file wins
+        tmp_path = '{}.{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(artifacts[0])
+        os.replace(tmp_path, path)
+        logger.info('compile cache saved to {}'.format(path))
+
+    def __getattr__(self, name):
+        # set_infer_output_stride, forward_features and the like go to the wrapped, uncompiled model
+        try:
+            return super(CompiledModel, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.model, name)
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger('SW-Infer')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """ sha1 of a file's content, read in chunks.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def settings_key(ckpt_path, settings):
+    """ key of an evaluation run, results are only reused under the same key.
+
+    Args:
+        ckpt_path: checkpoint file, identified by its content
+        settings: dict of the inference settings that change the predictions
+
+    Returns:
+        hex digest
+    """
+    h = hashlib.sha1()
+    h.update(file_hash(ckpt_path).encode())
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class EvalJournal(object):
+    """ append-only record of finished scenes, one json line per scene.
+
+    Each line holds the image path, the run key, the confusion matrix of the scene (None without
+    ground truth) and its timing. A line is written with a single append and synced, so an interrupted
+    run loses at most the scene in flight, and a torn last line is ignored when the journal is read back.
+    Several processes may append to the same journal. Lines of other keys are kept but not used.
+
+    With save_labels, the predicted labels of each scene are stored as a compressed npz next to the
+    journal before its line is written, so the scenes can be rescored without running the model.
+    """
+
+    def __init__(self, path, key, save_labels=False):
+        super(EvalJournal, self).__init__()
+        self.path = path
+        self.key = key
+        self.save_labels = save_labels
+        self.label_dir = path + '.labels'
+        self.records = dict()
+        if os.path.exists(path):
+            self._load()
+        if save_labels:
+            os.makedirs(self.label_dir, exist_ok=True)
+
+    def _load(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn line of an interrupted append
+                    continue
+                if record.get('key') == self.key:
+                    self.records[record['image']] = record
+        logger.info('journal {}: {} finished scenes'.format(self.path, len(self.records)))
+
+    def done(self, image):
+        record = self.records.get(image)
+        if record is None:
+            return False
+        return not self.save_labels or record.get('labels') is not None
+
+    def confusion_matrix(self, image):
+        """
+
+        Returns:
+            [#class, #class] int64 numpy array, None if the scene has no ground truth
+        """
+        cm = self.records[image]['cm']
+        return None if cm is None else np.asarray(cm, dtype=np.int64)
+
+    def labels(self, image):
+        """ cached [H, W] uint8 labels of a scene.
+        """
+        labels = self.records[image].get('labels')
+        if labels is None:
+            raise KeyError('no labels cached for {}.'.format(image))
+        with np.load(os.path.join(self.label_dir, labels)) as f:
+            return f['labels']
+
+    def record(self, image, cm=None, labels=None, **timing):
+        """ append a finished scene.
+
+        Args:
+            image: image path
+            cm: [#class, #class] confusion matrix (tensor or numpy array) or None
+            labels: [H, W] or [1, H, W] uint8 labels, stored if save_labels
+            timing: e.g. elapsed seconds and windows per second
+        """
+        record = dict(image=image, key=self.key, cm=None if cm is None else np.asarray(cm).tolist(), labels=None)
+        record.update(timing)
+        if self.save_labels and labels is not None:
+            name = '{}-{}.npz'.format(os.path.splitext(os.path.basename(image))[0], self.key[:12])
+            tmp = os.path.join(self.label_dir, name + '.tmp')
+            labels = np.asarray(labels)
+            with open(tmp, 'wb') as f:
+                np.savez_compressed(f, labels=labels.reshape(labels.shape[-2:]))
+            os.replace(tmp, os.path.join(self.label_dir, name))
+            record['labels'] = name
+        line = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.records[image] = record
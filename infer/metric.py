@@ -0,0 +1,111 @@
+import logging
+import os
+
+import numpy as np
+import torch
+
+logger = logging.getLogger('SW-Infer')
+
+
+class ConfusionMatrix(object):
+    """ streaming confusion matrix on the device of the predictions.
+
+    Each update is a bincount over num_classes * y_true + y_pred, done one band of rows at a time
+    so the int64 index buffer stays small, and only the [#class, #class] matrix is kept.
+    Rows are ground truth, columns are predictions, pixels labeled ignore_index are skipped.
+    """
+
+    def __init__(self, num_classes, ignore_index=255, band_rows=512):
+        super(ConfusionMatrix, self).__init__()
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.band_rows = band_rows
+        self.total = torch.zeros(num_classes, num_classes, dtype=torch.int64)
+
+    def reset(self):
+        self.total = torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64)
+
+    def _band(self, y_true, y_pred):
+        y_true = y_true.reshape(-1).long()
+        y_pred = y_pred.reshape(-1).long()
+        if self.ignore_index is not None:
+            valid = y_true != self.ignore_index
+            y_true = y_true[valid]
+            y_pred = y_pred[valid]
+        n = self.num_classes
+        return torch.bincount(n * y_true + y_pred, minlength=n * n).reshape(n, n)
+
+    def compute(self, y_true, y_pred):
+        """ confusion matrix of one image, on the device of y_pred.
+
+        Args:
+            y_true: [H, W] or [1, H, W] ground truth, numpy array or tensor
+            y_pred: [H, W] or [1, H, W] predicted labels, numpy array or tensor
+
+        Returns:
+            [#class, #class] int64 tensor
+        """
+        if isinstance(y_pred, np.ndarray):
+            y_pred = torch.from_numpy(y_pred)
+        if isinstance(y_true, np.ndarray):
+            y_true = torch.from_numpy(y_true)
+        y_pred = y_pred.reshape(y_pred.shape[-2:])
+        y_true = y_true.reshape(y_true.shape[-2:]).to(y_pred.device, non_blocking=True)
+        assert y_true.shape == y_pred.shape, 'ground truth {} and prediction {} differ in shape.'.format(
+            tuple(y_true.shape), tuple(y_pred.shape))
+
+        cm = torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64, device=y_pred.device)
+        for y0 in range(0, y_pred.size(0), self.band_rows):
+            y1 = y0 + self.band_rows
+            cm += self._band(y_true[y0:y1], y_pred[y0:y1])
+        return cm
+
+    def add(self, cm):
+        """ add a confusion matrix from compute, e.g. the one of a scene or of another worker.
+        """
+        self.total += cm.cpu()
+        return self
+
+    def forward(self, y_true, y_pred):
+        """ accumulate one image, same call as simplecv's NPmIoU.
+
+        Returns:
+            [#class, #class] confusion matrix of this image
+        """
+        cm = self.compute(y_true, y_pred)
+        self.add(cm)
+        return cm
+
+    def ious(self):
+        """
+
+        Returns:
+            per-class IoU as a float64 numpy array, nan for classes absent from both sides
+        """
+        cm = self.total.double()
+        tp = cm.diag()
+        union = cm.sum(dim=0) + cm.sum(dim=1) - tp
+        return (tp / union).numpy()
+
+    def summary(self, class_names=None, log_dir=None):
+        """ log the IoU table, and write it to log_dir/miou.txt as NPmIoU did if log_dir is given.
+
+        Returns:
+            per-class IoU numpy array, mIoU, nan if a class is absent from both sides as with NPmIoU
+        """
+        ious = self.ious()
+        # plain mean like NPmIoU and the foreground mIoU of isaid_eval, an absent class is not skipped
+        miou = float(ious.mean())
+        if class_names is None:
+            class_names = [str(i) for i in range(self.num_classes)]
+        width = max(len(name) for name in list(class_names) + ['mIoU'])
+        lines = ['{}  {}'.format('class'.ljust(width), 'iou')]
+        for name, iou in zip(class_names, ious):
+            lines.append('{}  {:.5f}'.format(name.ljust(width), iou))
+        lines.append('{}  {:.5f}'.format('mIoU'.ljust(width), miou))
+        logger.info('\n' + '\n'.join(lines))
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            with open(os.path.join(log_dir, 'miou.txt'), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        return ious, miou
@@ -0,0 +1,154 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger('SW-Infer')
+
+_END = object()
+
+
+class Stage(object):
+    """ one step of a Pipeline, run by num_workers threads.
+
+    fn(item) returns an iterable of output items (a generator is typical), so a stage can
+    fan out (one scene into many windows) or swallow items (a sink yields nothing).
+    A stage that holds items back across calls (e.g. to fill batches) gives flush(), which is
+    called by each worker once the input has ended and returns the remaining output items.
+    """
+
+    def __init__(self, name, fn, num_workers=1, flush=None):
+        super(Stage, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.flush = flush
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = dict(items=0, idle=0., blocked=0., depth_sum=0, depth_max=0)
+
+    def update_stats(self, **kwargs):
+        with self._lock:
+            for k, v in kwargs.items():
+                if k == 'depth_max':
+                    self.stats[k] = max(self.stats[k], v)
+                else:
+                    self.stats[k] += v
+
+    def summary(self):
+        items = max(self.stats['items'], 1)
+        return '{}: items = {}, idle = {:.2f}s, blocked = {:.2f}s, in-queue depth avg = {:.2f} / max = {}'.format(
+            self.name, self.stats['items'], self.stats['idle'], self.stats['blocked'],
+            self.stats['depth_sum'] / items, self.stats['depth_max'])
+
+
+class Pipeline(object):
+    """ threads connected by bounded queues.
+
+    A stage that is often idle waits for its producer, a stage that is often blocked
+    waits for its consumer, the bottleneck is the stage that is neither.
+    """
+
+    def __init__(self, stages, maxsize=2):
+        super(Pipeline, self).__init__()
+        self.stages = stages
+        self.maxsize = maxsize
+        self._stop = threading.Event()
+        self._error = None
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _emit(self, stage, outs, out_q):
+        for out in outs:
+            since = time.perf_counter()
+            self._put(out_q, out)
+            stage.update_stats(blocked=time.perf_counter() - since)
+
+    def _worker(self, stage, in_q, out_q, alive):
+        try:
+            while True:
+                depth = in_q.qsize()
+                since = time.perf_counter()
+                item = self._get(in_q)
+                idle = time.perf_counter() - since
+                if item is _END:
+                    # let the sibling workers see the end as well
+                    self._put(in_q, _END)
+                    if stage.flush is not None:
+                        self._emit(stage, stage.flush(), out_q)
+                    break
+                stage.update_stats(items=1, idle=idle, depth_sum=depth, depth_max=depth)
+                self._emit(stage, stage.fn(item), out_q)
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+        finally:
+            with alive['lock']:
+                alive['count'] -= 1
+                last = alive['count'] == 0
+            if last:
+                self._put(out_q, _END)
+
+    def run(self, items):
+        """ feed items through the stages.
+
+        Yields:
+            outputs of the last stage
+        """
+        self._stop.clear()
+        self._error = None
+        for stage in self.stages:
+            stage.reset_stats()
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in range(len(self.stages) + 1)]
+        threads = []
+        for stage, in_q, out_q in zip(self.stages, queues[:-1], queues[1:]):
+            alive = dict(lock=threading.Lock(), count=stage.num_workers)
+            for i in range(stage.num_workers):
+                t = threading.Thread(target=self._worker, args=(stage, in_q, out_q, alive),
+                                     name='{}-{}'.format(stage.name, i), daemon=True)
+                t.start()
+                threads.append(t)
+
+        def _feed():
+            for item in items:
+                if self._stop.is_set():
+                    break
+                self._put(queues[0], item)
+            self._put(queues[0], _END)
+
+        feeder = threading.Thread(target=_feed, name='feed', daemon=True)
+        feeder.start()
+        try:
+            while True:
+                out = self._get(queues[-1])
+                if out is _END:
+                    break
+                yield out
+        finally:
+            self._stop.set()
+            feeder.join()
+            for t in threads:
+                t.join()
+        if self._error is not None:
+            raise self._error
+
+    def log_stats(self):
+        for stage in self.stages:
+            logger.info(stage.summary())
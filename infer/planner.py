@@ -0,0 +1,144 @@
+import math
+
+import numpy as np
+
+
+def _plan_axis(length, patch, min_overlap, align=1):
+    """ fewest window starts along one axis with at least min_overlap pixels between neighbours.
+
+    Returns:
+        sorted unique starts, the first at 0 and the last at length - patch
+    """
+    patch = min(patch, length)
+    if patch == length:
+        return np.zeros((1,), dtype=np.int64)
+    # rounding the starts down to multiples of align may cost up to align - 1 pixels of overlap
+    step = patch - min_overlap - (align - 1)
+    if step <= 0:
+        raise ValueError('min_overlap ({}) should be smaller than the patch size ({}).'.format(min_overlap, patch))
+    num = int(math.ceil((length - patch) / step)) + 1
+    # spread the windows evenly, the actual overlap is >= min_overlap
+    starts = np.floor(np.arange(num) * (length - patch) / (num - 1)).astype(np.int64)
+    starts = starts // align * align
+    return np.unique(starts)
+
+
+def plan_windows(input_size, patch_size, min_overlap=0, halo=None, align=1):
+    """ smallest grid of windows that covers the image.
+
+    Args:
+        input_size: (H, W)
+        patch_size: (h, w), clipped to the image
+        min_overlap: minimum overlap between neighbouring windows
+        halo: context each window needs on every inner side, overrides min_overlap by 2 * halo,
+            which is what center-crop stitching requires
+        align: window starts are multiples of align, input_size and patch_size should be as well
+
+    Returns:
+        [N, 4] windows (x1, y1, x2, y2) in raster order, without duplicates
+    """
+    ih, iw = input_size
+    ph, pw = min(patch_size[0], ih), min(patch_size[1], iw)
+    if halo is not None:
+        min_overlap = 2 * halo
+    ys = _plan_axis(ih, ph, min_overlap, align)
+    xs = _plan_axis(iw, pw, min_overlap, align)
+    y, x = np.meshgrid(ys, xs, indexing='ij')
+    y, x = y.ravel(), x.ravel()
+    return np.stack([x, y, x + pw, y + ph], axis=1)
+
+
+def compute_amplification(wins, input_size):
+    """ window pixels / image pixels, 1.0 means every pixel is computed exactly once.
+    """
+    area = np.sum((wins[:, 2] - wins[:, 0]) * (wins[:, 3] - wins[:, 1]))
+    return float(area) / float(input_size[0] * input_size[1])
+
+
+def _keep_axis(intervals, length):
+    """ split the overlap of neighbouring intervals at its middle.
+
+    Returns:
+        dict, (start, end) -> (keep start, keep end)
+    """
+    intervals = sorted(set(intervals))
+    keep = dict()
+    for i, (s, e) in enumerate(intervals):
+        lo = 0 if i == 0 else max(s, (intervals[i - 1][1] + s) // 2)
+        hi = length if i == len(intervals) - 1 else min(e, (e + intervals[i + 1][0]) // 2)
+        keep[(s, e)] = (lo, hi)
+    return keep
+
+
+def center_crop_regions(wins, input_size):
+    """ part of each window that is kept by center-crop stitching.
+
+    The windows should form a grid, as produced by plan_windows or sliding_window. Every pixel
+    is kept by exactly one window, the one whose border is farthest away.
+
+    Returns:
+        [N, 4] kept boxes (x1, y1, x2, y2) in image coordinates
+    """
+    ih, iw = input_size
+    keep_x = _keep_axis([(int(win[0]), int(win[2])) for win in wins], iw)
+    keep_y = _keep_axis([(int(win[1]), int(win[3])) for win in wins], ih)
+    boxes = []
+    for win in wins:
+        x1, x2 = keep_x[(int(win[0]), int(win[2]))]
+        y1, y2 = keep_y[(int(win[1]), int(win[3]))]
+        boxes.append((x1, y1, x2, y2))
+    return np.asarray(boxes, dtype=np.int64).reshape((-1, 4))
+
+
+def _group_axis(intervals, tile_size, halo):
+    """ split sorted intervals into runs whose extent plus a halo on both sides fits into tile_size.
+
+    Returns:
+        list of lists of intervals
+    """
+    groups = [[intervals[0]]]
+    for s, e in intervals[1:]:
+        if e - groups[-1][0][0] + 2 * halo <= tile_size:
+            groups[-1].append((s, e))
+        else:
+            groups.append([(s, e)])
+    return groups
+
+
+def plan_tiles(wins, input_size, tile_size, halo, align=32):
+    """ group a grid of windows into larger tiles that are encoded at once.
+
+    Each tile holds a block of neighbouring windows and extends them by halo pixels of context on every
+    side (clipped to the image), so a pixel is encoded by about one tile instead of by every window
+    overlapping it.
+
+    Args:
+        wins: [N, 4] windows forming a grid, starts aligned to align
+        input_size: (H, W), multiples of align
+        tile_size: largest tile side, a single window (plus halo) is used if it does not fit
+        halo: context around the windows of a tile
+        align: tile starts and ends are multiples of align
+
+    Returns:
+        [T, 4] tiles (x1, y1, x2, y2), list of T arrays of window indices
+    """
+    ih, iw = input_size
+
+    def _tiles(intervals, length):
+        tiles = dict()
+        for group in _group_axis(sorted(set(intervals)), tile_size, halo):
+            t1 = max(group[0][0] - halo, 0) // align * align
+            t2 = min(-(-(max(e for _, e in group) + halo) // align) * align, length)
+            for interval in group:
+                tiles[interval] = (t1, t2)
+        return tiles
+
+    tiles_x = _tiles([(int(win[0]), int(win[2])) for win in wins], iw)
+    tiles_y = _tiles([(int(win[1]), int(win[3])) for win in wins], ih)
+    tiles = dict()
+    for i, win in enumerate(wins):
+        x1, x2 = tiles_x[(int(win[0]), int(win[2]))]
+        y1, y2 = tiles_y[(int(win[1]), int(win[3]))]
+        tiles.setdefault((x1, y1, x2, y2), []).append(i)
+    keys = sorted(tiles, key=lambda t: (t[1], t[0]))
+    return np.asarray(keys, dtype=np.int64).reshape((-1, 4)), [np.asarray(tiles[k], dtype=np.int64) for k in keys]
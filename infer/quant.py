@@ -0,0 +1,73 @@
+import itertools
+import json
+import logging
+
+import torch
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx
+from torch.ao.quantization.quantize_fx import prepare_fx
+
+logger = logging.getLogger('SW-Infer')
+
+# kept in fp32: the classifier and everything after it, so that the probabilities are not quantized
+FLOAT_MODULES = ('cls_pred_conv', 'upsample4x_op')
+
+
+def quantize_static(model, calib_batches, backend='x86', float_modules=FLOAT_MODULES):
+    """ post-training static int8 quantization in FX graph mode, for cpu inference.
+
+    Conv + BatchNorm (+ ReLU) are fused, observers record the activation ranges over the calibration
+    batches and the model is converted to quantized kernels. The model is traced in eval mode, settings
+    read in forward (e.g. the infer output stride) are frozen into the graph.
+
+    Args:
+        model: float model in eval mode on the cpu
+        calib_batches: iterable of [N, C, H, W] normalized image batches
+        backend: quantized engine, 'x86', 'fbgemm' or 'qnnpack'
+        float_modules: names of submodules left in fp32
+
+    Returns:
+        quantized torch.fx.GraphModule
+    """
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for name in float_modules:
+        qconfig_mapping.set_module_name(name, None)
+    qconfig_mapping.set_object_type(F.softmax, None).set_object_type('softmax', None)
+
+    calib_batches = iter(calib_batches)
+    first = next(calib_batches)
+    prepared = prepare_fx(model.eval(), qconfig_mapping, (first,))
+    num_images = 0
+    with torch.no_grad():
+        for images in itertools.chain([first], calib_batches):
+            prepared(images)
+            num_images += images.size(0)
+    logger.info('calibrated on {} images'.format(num_images))
+    return convert_fx(prepared)
+
+
+def save_quantized(path, model, example, **meta):
+    """ save a quantized model as traced TorchScript together with the settings it was traced with,
+    loading it needs neither the model code nor the config.
+
+    Args:
+        example: [N, C, H, W] input to trace with, the traced graph accepts other batch and window sizes
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_trace=False)
+    torch.jit.save(traced, path, _extra_files={'meta.json': json.dumps(meta)})
+
+
+def load_quantized(path):
+    """
+
+    Returns:
+        quantized model in eval mode, dict of the settings it was traced with
+    """
+    extra_files = {'meta.json': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'])
+    torch.backends.quantized.engine = meta.get('backend', torch.backends.quantized.engine)
+    return model.eval(), meta
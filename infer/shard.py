@@ -0,0 +1,26 @@
+import heapq
+
+
+def shard_by_pixels(sizes, num_shards):
+    """ split scenes into shards of balanced pixel count.
+
+    Greedy longest-processing-time: scenes are taken from the largest down and each goes to the
+    shard with the fewest pixels so far, the heaviest shard is within 4/3 of the optimum.
+
+    Args:
+        sizes: list of (H, W), one per scene
+        num_shards: number of shards
+
+    Returns:
+        list of num_shards sorted index lists, list of their pixel counts
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][0] * sizes[i][1], i))
+    heap = [(0, rank) for rank in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for i in order:
+        load, rank = heapq.heappop(heap)
+        shards[rank].append(i)
+        loads[rank] = load + sizes[i][0] * sizes[i][1]
+        heapq.heappush(heap, (loads[rank], rank))
+    return [sorted(shard) for shard in shards], loads
@@ -0,0 +1,692 @@
+import contextlib
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from simplecv.data.preprocess import sliding_window
+from tqdm import tqdm
+
+from infer.planner import center_crop_regions
+from infer.planner import compute_amplification
+from infer.planner import plan_tiles
+from infer.planner import plan_windows
+from infer.stitch import BandAccumulator
+from infer.stitch import build_accumulator
+from infer.tta import TTAModel
+
+logger = logging.getLogger('SW-Infer')
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _is_oom(e):
+    oom_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if oom_error is not None and isinstance(e, oom_error):
+        return True
+    msg = str(e)
+    return isinstance(e, RuntimeError) and ('out of memory' in msg or "can't allocate memory" in msg)
+
+
+class SegmSlidingWinInference(object):
+    def __init__(self, batch_size=None, max_batch_size=16, output_mode='float32', mmap_dir=None,
+                 scene_on_device=False, min_overlap=None, halo=None, stitch_mode='average', output_stride=1,
+                 oom_halo=64, tta=None, shared_tile=None, shared_halo=128, precision='fp32',
+                 channels_last=False):
+        """
+
+        Args:
+            batch_size: number of windows per forward pass, inferred from free device memory if None
+            max_batch_size: upper bound used when the batch size is inferred
+            output_mode: stitching canvas, one of 'float32', 'float16', 'uint8' (quantized probabilities)
+                and 'label' (running argmax, no probability canvas)
+            mmap_dir: if given, the float canvas and count map are numpy.memmap files in this directory
+            scene_on_device: keep the normalized scene on the model device instead of the host
+            min_overlap: if given, windows come from planner.plan_windows instead of a fixed stride
+            halo: context each window needs on its inner sides, planned as min_overlap = 2 * halo
+            stitch_mode: 'average', 'gaussian' or 'center', see stitch.Stitcher
+            output_stride: stride of the model output (see FarSeg.set_infer_output_stride), predictions are
+                stitched at this stride and upsampled once per scene
+            oom_halo: context kept around each sub-window when a single window has to be split
+                after an allocation failure
+            tta: test-time augmentation, a set of tta.TTA_SETS or comma separated transforms of tta.TRANSFORMS,
+                the augmented copies of a batch go through the model as one larger batch
+            shared_tile: if given, iter_outputs_shared encodes blocks of windows as tiles of at most this size,
+                windows are then aligned to 32 so that they can be cropped from the encoder features
+            shared_halo: context around the windows of a shared tile
+            precision: 'fp32', 'bf16' or 'fp16', the model runs under autocast to this dtype, fp16 falls back to
+                bf16 on the cpu. Outputs are stitched in fp32, see precision_guard to check a scene against fp32
+            channels_last: the scene and the window batches are laid out channels last (NHWC), for a model
+                converted with set_memory_format(torch.channels_last)
+        """
+        super(SegmSlidingWinInference, self).__init__()
+        self._h = None
+        self._w = None
+        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.output_mode = output_mode
+        self.mmap_dir = mmap_dir
+        self.scene_on_device = scene_on_device
+        self.min_overlap = min_overlap
+        self.halo = halo
+        self.stitch_mode = stitch_mode
+        self.output_stride = output_stride
+        self.oom_halo = oom_halo
+        self.tta = tta
+        self.shared_tile = shared_tile
+        self.shared_halo = shared_halo
+        if precision not in ('fp32', 'bf16', 'fp16'):
+            raise ValueError('precision should be fp32, bf16 or fp16, got {}.'.format(precision))
+        self.precision = precision
+        self.channels_last = channels_last
+        # inferred (or reduced after an allocation failure) batch size per padded window shape
+        self._inferred_batch_size = dict()
+        # sub-window size per padded window shape, set when a single window does not fit
+        self._tile_size = dict()
+        self.stats = dict()
+
+    def patch(self, input_size, patch_size, stride, transforms=None):
+        """ divide large image into small patches.
+
+        Returns:
+
+        """
+        self.wins = self.make_wins(input_size, patch_size, stride)
+        self.transforms = transforms
+        return self
+
+    def make_wins(self, input_size, patch_size, stride):
+        """ fixed stride windows, or the smallest covering grid if min_overlap or halo is set.
+
+        With output_stride > 1 the windows are laid out on the image padded to a multiple of
+        output_stride, so that they are aligned to the stride-s canvas. With shared_tile they are laid out
+        on the image padded to a multiple of 32 and their ends are clipped back to the stride-s canvas.
+
+        Returns:
+            [N, 4] windows (x1, y1, x2, y2) in raster order, windows of a row band are stitched together
+        """
+        s = self.output_stride
+        canvas_size = tuple(-(-v // s) * s for v in input_size)
+        a = 32 if self.shared_tile is not None else s
+        input_size = tuple(-(-v // a) * a for v in input_size)
+        if self.min_overlap is not None or self.halo is not None:
+            wins = plan_windows(input_size, patch_size, min_overlap=self.min_overlap or 0, halo=self.halo, align=a)
+        else:
+            # small scenes repeat windows, a repeated window would be added twice in center stitching
+            wins = np.unique(sliding_window(input_size, patch_size, stride), axis=0)
+            wins = wins[np.lexsort((wins[:, 0], wins[:, 1]))]
+        if a != s:
+            wins = wins.copy()
+            wins[:, 2] = np.minimum(wins[:, 2], canvas_size[1])
+            wins[:, 3] = np.minimum(wins[:, 3], canvas_size[0])
+        return wins
+
+    def forward(self, model, image_np, **kwargs):
+        assert self.wins is not None, 'patch must be performed before forward.'
+        # set the image height and width
+        self._h, self._w, _ = image_np.shape
+        return self._forward(model, image_np, **kwargs)
+
+    def prepare_scene(self, image_np):
+        """ convert and normalize the whole image once, windows are then views into it.
+
+        Args:
+            image_np: [H, W, C] image
+
+        Returns:
+            [1, C, H, W] float tensor, on the model device if scene_on_device,
+                zero padded to a multiple of output_stride (32 with shared_tile), channels last if channels_last
+        """
+        image = image_np.astype(np.float32)
+        if self.transforms is not None:
+            scene = self.transforms(image)
+        else:
+            scene = torch.from_numpy(image).permute(2, 0, 1).unsqueeze(0)
+        del image
+        s = 32 if self.shared_tile is not None else self.output_stride
+        h, w = scene.shape[2:4]
+        if h % s or w % s:
+            scene = self._pad(scene, -(-h // s) * s, -(-w // s) * s)
+        if self.channels_last:
+            # windows are views into the scene, their batches come out of torch.cat channels last as well
+            scene = scene.contiguous(memory_format=torch.channels_last)
+        if self.scene_on_device:
+            scene = scene.to(self.device)
+        return scene
+
+    def _autocast(self):
+        """ autocast context of the model forward, a no-op for fp32.
+        """
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        dtype = torch.float16 if self.precision == 'fp16' and self.device.type == 'cuda' else torch.bfloat16
+        return torch.autocast(self.device.type, dtype=dtype)
+
+    def _to_device(self, images):
+        images = images.to(self.device)
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    @staticmethod
+    def _window(scene, win):
+        x1, y1, x2, y2 = win
+        return scene[:, :, y1:y2, x1:x2]
+
+    @staticmethod
+    def _batch_shape(wins, size_divisor):
+        """ common (h, w) that every window of the current image is padded to.
+        """
+        max_h = int(max(win[3] - win[1] for win in wins))
+        max_w = int(max(win[2] - win[0] for win in wins))
+        if size_divisor is not None:
+            max_h = int(np.ceil(max_h / size_divisor) * size_divisor)
+            max_w = int(np.ceil(max_w / size_divisor) * size_divisor)
+        return max_h, max_w
+
+    def _infer_batch_size(self, model, image, pad_shape):
+        """ run one window alone and estimate how many of them fit into the free device memory.
+
+        Returns:
+            batch size, output of the probe window
+        """
+        if self.device.type != 'cuda':
+            with torch.no_grad(), self._autocast():
+                out = model(image).float()
+            self._inferred_batch_size[pad_shape] = 1
+            return 1, out
+
+        torch.cuda.reset_peak_memory_stats(self.device)
+        base = torch.cuda.memory_allocated(self.device)
+        with torch.no_grad(), self._autocast():
+            out = model(image).float()
+        per_win = max(torch.cuda.max_memory_allocated(self.device) - base, 1)
+        free, _ = torch.cuda.mem_get_info(self.device)
+        batch_size = int(min(max(free * 0.8 // per_win, 1), self.max_batch_size))
+        self._inferred_batch_size[pad_shape] = batch_size
+        logger.info('inferred batch size = {} for window shape {}'.format(batch_size, pad_shape))
+        return batch_size, out
+
+    def _release(self):
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def _recover_from_oom(self, batch_size, pad_shape, align):
+        """ halve the batch, or once a single window fails, halve its sub-window size.
+        The reduced size is kept for the later windows of the same padded shape.
+
+        Returns:
+            batch size to retry with
+        """
+        if batch_size > 1:
+            batch_size = batch_size // 2
+            self._inferred_batch_size[pad_shape] = batch_size
+            logger.warning('out of memory, batch size reduced to {} for window shape {}'.format(batch_size, pad_shape))
+            return batch_size
+
+        th, tw = self._tile_size.get(pad_shape, pad_shape)
+        if th >= tw:
+            th = -(-th // 2 // align) * align
+        else:
+            tw = -(-tw // 2 // align) * align
+        if min(th, tw) <= 2 * self.oom_halo:
+            raise RuntimeError('out of memory even with {}x{} sub-windows and halo {}.'.format(th, tw, self.oom_halo))
+        self._tile_size[pad_shape] = (th, tw)
+        self._inferred_batch_size[pad_shape] = 1
+        logger.warning('out of memory, window shape {} split into {}x{} sub-windows'.format(pad_shape, th, tw))
+        return 1
+
+    def _model_forward(self, model, images, pad_shape):
+        """ forward a batch, or a single window in sub-windows with a halo if it does not fit at once.
+
+        Returns:
+            output on the host
+        """
+        if pad_shape not in self._tile_size:
+            with torch.no_grad(), self._autocast():
+                return model(images).float().cpu()
+
+        s = self.output_stride
+        h, w = images.shape[2:4]
+        tiles = plan_windows((h, w), self._tile_size[pad_shape], halo=self.oom_halo, align=32)
+        keeps = center_crop_regions(tiles, (h, w))
+        out = None
+        for (x1, y1, x2, y2), (kx1, ky1, kx2, ky2) in zip(tiles, keeps):
+            with torch.no_grad(), self._autocast():
+                tile_out = model(images[:, :, y1:y2, x1:x2]).float().cpu()
+            if out is None:
+                out = torch.empty(images.size(0), tile_out.size(1), h // s, w // s, dtype=tile_out.dtype)
+            out[:, :, ky1 // s:ky2 // s, kx1 // s:kx2 // s] = \
+                tile_out[:, :, (ky1 - y1) // s:(ky2 - y1) // s, (kx1 - x1) // s:(kx2 - x1) // s]
+            del tile_out
+        return out
+
+    def _iter_batches(self, model, windows, pad_shape, align):
+        """ forward windows of the same padded shape in batches.
+
+        Args:
+            windows: list of (scene, win), the windows may come from different scenes
+            pad_shape: (h, w) every window is padded to
+            align: alignment of sub-windows if a single window does not fit
+
+        Yields:
+            (index into windows, [1, #class, h / s, w / s] prediction cropped to its window,
+                seconds of its batch per window)
+        """
+        pad_h, pad_w = pad_shape
+        batch_size = self._inferred_batch_size.get(pad_shape, self.batch_size)
+        s = self.output_stride
+        if self.tta is not None:
+            model = TTAModel(model, self.tta)
+        idx = 0
+        while idx < len(windows):
+            since = time.perf_counter()
+            if batch_size is None:
+                # probe with a single window, its output is kept
+                scene, win = windows[idx]
+                image = self._to_device(self._pad(self._window(scene, win), pad_h, pad_w))
+                try:
+                    batch_size, out = self._infer_batch_size(model, image, pad_shape)
+                except RuntimeError as e:
+                    if not _is_oom(e):
+                        raise
+                    out = None
+                if out is None:
+                    del image
+                    self._release()
+                    batch_size = self._inferred_batch_size[pad_shape] = 1
+                    continue
+                yield idx, out[:, :, :(win[3] - win[1]) // s, :(win[2] - win[0]) // s], time.perf_counter() - since
+                del out
+                idx += 1
+                continue
+
+            batch = windows[idx: idx + batch_size]
+            images = torch.cat([self._pad(self._window(scene, win), pad_h, pad_w) for scene, win in batch], dim=0)
+            images = self._to_device(images)
+            try:
+                out = self._model_forward(model, images, pad_shape)
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+                out = None
+            if out is None:
+                # leave the except block first, the traceback holds the failed activations
+                del images
+                self._release()
+                batch_size = self._recover_from_oom(len(batch), pad_shape, align)
+                continue
+            per_win = (time.perf_counter() - since) / len(batch)
+            for i, (_, win) in enumerate(batch):
+                h, w = (win[3] - win[1]) // s, (win[2] - win[0]) // s
+                yield idx + i, out[i:i + 1, :, :h, :w], per_win
+            del images, out
+            idx += len(batch)
+
+    def iter_outputs(self, model, scene, wins, size_divisor=None):
+        """ run the model over the windows in order.
+
+        Args:
+            scene: [1, C, H, W] normalized image from prepare_scene
+            wins: windows from make_wins
+
+        Yields:
+            ([1, #class, h / s, w / s] prediction cropped to its window, window), s is the output stride
+        """
+        num_wins = len(wins)
+        if num_wins == 0:
+            self.stats = dict(num_windows=0, batch_size=self.batch_size, elapsed=0., windows_per_second=0.,
+                              amplification=0.)
+            return
+        pad_shape = self._batch_shape(wins, size_divisor)
+        pbar = tqdm(total=num_wins)
+        _synchronize(self.device)
+        since = time.perf_counter()
+        for idx, pred, _ in self._iter_batches(model, [(scene, win) for win in wins], pad_shape, size_divisor or 32):
+            yield pred, wins[idx]
+            pbar.update(1)
+        _synchronize(self.device)
+        elapsed = time.perf_counter() - since
+        pbar.close()
+
+        self.stats = dict(num_windows=num_wins,
+                          batch_size=self._inferred_batch_size.get(pad_shape, self.batch_size),
+                          elapsed=elapsed,
+                          windows_per_second=num_wins / max(elapsed, 1e-6),
+                          amplification=compute_amplification(wins, scene.shape[2:4]))
+        logger.info('{num_windows} windows, batch size = {batch_size}, '
+                    '{windows_per_second:.2f} windows/s, compute amplification = {amplification:.2f}x'.format(
+            **self.stats))
+
+    def iter_outputs_shared(self, model, scene, wins, size_divisor=None):
+        """ run the encoder once per tile of neighbouring windows and the head once per window.
+
+        Windows are grouped into tiles of at most shared_tile pixels plus shared_halo pixels of context
+        (planner.plan_tiles), the model encodes a tile with forward_features, the features of each window
+        are cropped from those of its tile at every feature stride and forward_head runs on a batch of
+        cropped windows. The encoder then computes each pixel about once instead of once per overlapping
+        window. Predictions differ slightly from iter_outputs since the encoder of a window sees the
+        tile context instead of zero padding, the labels agree on more than 99% of the pixels (pinned on a toy
+        model in tests/test_shared_backbone.py). With a tile of one window and no halo the outputs match
+        iter_outputs up to float rounding. A tile that does not fit into memory falls back to iter_outputs.
+
+        Args:
+            model: with forward_features, forward_head and feature_strides (see FarSeg)
+            scene: [1, C, H, W] normalized image from prepare_scene
+            wins: windows from make_wins, starts aligned to 32
+
+        Yields:
+            ([1, #class, h / s, w / s] prediction cropped to its window, window), tile by tile,
+                windows of a tile in raster order
+        """
+        if not hasattr(model, 'forward_features'):
+            raise ValueError('shared backbone inference needs forward_features and forward_head, '
+                             '{} has none.'.format(type(model).__name__))
+        if self.tta is not None:
+            raise ValueError('shared backbone inference does not support tta.')
+        num_wins = len(wins)
+        if num_wins == 0:
+            self.stats = dict(num_windows=0, num_tiles=0, elapsed=0., windows_per_second=0.,
+                              amplification=0., encoder_amplification=0.)
+            return
+        if np.any(wins[:, :2] % 32):
+            raise ValueError('windows of shared backbone inference should start at multiples of 32.')
+        s = self.output_stride
+        strides = model.feature_strides
+        batch_size = self.batch_size or self.max_batch_size
+        tiles, groups = plan_tiles(wins, scene.shape[2:4], self.shared_tile, self.shared_halo)
+        pbar = tqdm(total=num_wins)
+        _synchronize(self.device)
+        since = time.perf_counter()
+        for (tx1, ty1, tx2, ty2), idxs in zip(tiles, groups):
+            try:
+                with torch.no_grad(), self._autocast():
+                    feats = model.forward_features(self._to_device(self._window(scene, (tx1, ty1, tx2, ty2))))
+            except RuntimeError as e:
+                if not _is_oom(e):
+                    raise
+                feats = None
+            if feats is None:
+                self._release()
+                logger.warning('out of memory, tile {} falls back to windowed inference'.format(
+                    (tx1, ty1, tx2, ty2)))
+                tile_wins = wins[idxs]
+                for pred, win in self.iter_outputs(model, scene, tile_wins, size_divisor):
+                    yield pred, win
+                    pbar.update(1)
+                continue
+
+            # group the windows of a tile by crop size, the features of each group go to the head as one batch
+            shapes = dict()
+            for i in idxs:
+                x1, y1, x2, y2 = wins[i]
+                shapes.setdefault((-(-(y2 - y1) // 32) * 32, -(-(x2 - x1) // 32) * 32), []).append(i)
+            for (ch, cw), shape_idxs in shapes.items():
+                for j in range(0, len(shape_idxs), batch_size):
+                    batch = shape_idxs[j:j + batch_size]
+                    crops = []
+                    for f, st in zip(feats, strides):
+                        crops.append(torch.cat([
+                            f[:, :, (wins[i][1] - ty1) // st:(wins[i][1] - ty1 + ch) // st,
+                              (wins[i][0] - tx1) // st:(wins[i][0] - tx1 + cw) // st] for i in batch], dim=0))
+                    with torch.no_grad(), self._autocast():
+                        out = model.forward_head(crops).float().cpu()
+                    del crops
+                    for k, i in enumerate(batch):
+                        x1, y1, x2, y2 = wins[i]
+                        yield out[k:k + 1, :, :(y2 - y1) // s, :(x2 - x1) // s], wins[i]
+                        pbar.update(1)
+                    del out
+            del feats
+        _synchronize(self.device)
+        elapsed = time.perf_counter() - since
+        pbar.close()
+
+        self.stats = dict(num_windows=num_wins,
+                          num_tiles=len(tiles),
+                          elapsed=elapsed,
+                          windows_per_second=num_wins / max(elapsed, 1e-6),
+                          amplification=compute_amplification(wins, scene.shape[2:4]),
+                          encoder_amplification=compute_amplification(tiles, scene.shape[2:4]))
+        logger.info('{num_windows} windows in {num_tiles} tiles, {windows_per_second:.2f} windows/s, '
+                    'encoder amplification = {encoder_amplification:.2f}x, '
+                    'head amplification = {amplification:.2f}x'.format(**self.stats))
+
+    def precision_guard(self, model, scene, wins, num_windows=4, threshold=0.01, size_divisor=None):
+        """ run a sample of the windows both in fp32 and in the inference precision and compare their labels.
+
+        The windows are spread evenly over wins and padded like in iter_outputs, a warning is logged if the
+        fraction of disagreeing labels exceeds threshold.
+
+        Args:
+            scene: [1, C, H, W] normalized image from prepare_scene
+            wins: windows from make_wins
+
+        Returns:
+            number of compared pixels, number of disagreeing pixels
+        """
+        if self.precision == 'fp32' or len(wins) == 0:
+            return 0, 0
+        s = self.output_stride
+        pad_h, pad_w = self._batch_shape(wins, size_divisor)
+        num_pixels, num_disagree = 0, 0
+        for idx in np.unique(np.linspace(0, len(wins) - 1, min(num_windows, len(wins))).round().astype(np.int64)):
+            win = wins[idx]
+            image = self._to_device(self._pad(self._window(scene, win), pad_h, pad_w))
+            h, w = (win[3] - win[1]) // s, (win[2] - win[0]) // s
+            with torch.no_grad():
+                ref = model(image)[:, :, :h, :w].argmax(dim=1)
+                with self._autocast():
+                    labels = model(image)[:, :, :h, :w].argmax(dim=1)
+            num_pixels += ref.numel()
+            num_disagree += int((labels != ref).sum())
+            del image, ref, labels
+        disagreement = num_disagree / max(num_pixels, 1)
+        if disagreement > threshold:
+            logger.warning('{} labels disagree with fp32 on {:.3%} of the pixels of {} sampled windows, '
+                           'more than {:.3%}'.format(self.precision, disagreement, min(num_windows, len(wins)),
+                                                     threshold))
+        return num_pixels, num_disagree
+
+    def scout(self, model, scene, wins, scale=0.25, threshold=0.1, margin=64, size_divisor=None):
+        """ low resolution pass over the whole scene to find the windows that may contain foreground.
+
+        The scene is downsampled by area averaging and covered by the fewest windows of the same size,
+        a full resolution window is kept if the foreground probability (1 - background) reaches threshold
+        anywhere within margin pixels around it. A lower threshold and a larger margin trade speed for recall.
+
+        Args:
+            scene: [1, C, H, W] normalized image from prepare_scene
+            wins: full resolution windows from make_wins
+
+        Returns:
+            [N] bool numpy array, True for the windows to run at full resolution,
+                the stats of the low resolution pass are kept in stats['scout']
+        """
+        stats = self.stats
+        s = self.output_stride
+        h, w = scene.shape[2:4]
+        low = F.interpolate(scene, scale_factor=scale, mode='area')
+        lh, lw = low.shape[2:4]
+        low = self._pad(low, -(-lh // s) * s, -(-lw // s) * s)
+        lh, lw = low.shape[2:4]
+        patch_size = (int(max(wins[:, 3] - wins[:, 1])), int(max(wins[:, 2] - wins[:, 0])))
+        low_wins = plan_windows((lh, lw), patch_size, align=s)
+        acc = build_accumulator('float32', lh, lw, low_wins, output_stride=s)
+        for pred, win in self.iter_outputs(model, low, low_wins, size_divisor):
+            acc.add(pred, win)
+        # the low resolution pass does not replace the stats of the scene
+        self.stats = dict(stats, scout=self.stats)
+        fg = 1. - acc.result()[0, 0]
+
+        ry, rx = fg.size(0) / h, fg.size(1) / w
+        keep = np.zeros((len(wins),), dtype=bool)
+        for i, (x1, y1, x2, y2) in enumerate(wins):
+            y1, x1 = int(np.floor(max(y1 - margin, 0) * ry)), int(np.floor(max(x1 - margin, 0) * rx))
+            y2, x2 = int(np.ceil(min(y2 + margin, h) * ry)), int(np.ceil(min(x2 + margin, w) * rx))
+            keep[i] = bool(fg[y1:y2, x1:x2].max() >= threshold)
+        return keep
+
+    def background_output(self, win, num_classes):
+        """ one-hot background prediction of a window skipped by scout, stitched in place of the model output so
+        that it votes for background in the overlaps and the stitched average stays a probability.
+
+        Returns:
+            [1, #class, h / s, w / s] float32 prediction, s is the output stride
+        """
+        s = self.output_stride
+        x1, y1, x2, y2 = (int(v) for v in win)
+        out = torch.zeros((1, num_classes, (y2 - y1) // s, (x2 - x1) // s), dtype=torch.float32)
+        out[:, 0] = 1.
+        return out
+
+    def _forward(self, model, image_np, **kwargs):
+        self.device = kwargs.get('device', self.device)
+        size_divisor = kwargs.get('size_divisor', None)
+        return_labels = kwargs.get('return_labels', False)
+        assert self.wins is not None, 'patch must be performed before forward.'
+
+        acc = build_accumulator(self.output_mode, self._h, self._w, self.wins, self.mmap_dir, self.stitch_mode,
+                                self.output_stride)
+        scene = self.prepare_scene(image_np)
+        iter_outputs = self.iter_outputs if self.shared_tile is None else self.iter_outputs_shared
+        for pred, win in iter_outputs(model, scene, self.wins, size_divisor):
+            acc.add(pred, win)
+        self.wins = None
+
+        if return_labels:
+            return acc.labels()
+        return acc.result()
+
+    def forward_bands(self, model, image_np, **kwargs):
+        """ streaming version of forward.
+
+        Windows are processed in raster order and a horizontal band of rows is yielded as soon as
+        no remaining window overlaps it, so memory is bounded by about one patch-height band.
+        float16 output mode keeps the band in half precision, other modes use float32.
+
+        Yields:
+            (y0, y1, band), band is [1, y1 - y0, W] uint8 labels if return_labels
+                else [1, #class, y1 - y0, W] averaged prediction
+        """
+        assert self.wins is not None, 'patch must be performed before forward.'
+        assert self.output_stride == 1, 'forward_bands works at full resolution.'
+        assert self.shared_tile is None, 'forward_bands needs the windows in raster order.'
+        self._h, self._w, _ = image_np.shape
+        self.device = kwargs.get('device', self.device)
+        size_divisor = kwargs.get('size_divisor', None)
+        return_labels = kwargs.get('return_labels', False)
+
+        wins = self.wins
+        acc = BandAccumulator(self._h, self._w, wins,
+                              dtype=torch.float16 if self.output_mode == 'float16' else torch.float32,
+                              stitch_mode=self.stitch_mode)
+        scene = self.prepare_scene(image_np)
+        for idx, (pred, win) in enumerate(self.iter_outputs(model, scene, wins, size_divisor)):
+            acc.add(pred, win)
+            # windows are sorted by y1, rows above the next window are final
+            next_y = int(wins[idx + 1][1]) if idx + 1 < len(wins) else self._h
+            if next_y > acc.top:
+                y0 = acc.top
+                band = acc.release(next_y, return_labels)
+                yield y0, next_y, band
+        self.wins = None
+
+    @staticmethod
+    def _pad(image, pad_h, pad_w):
+        """ zero pad a [1, C, h, w] window on the bottom and right, same as th_divisible_pad.
+        Windows that need no padding are returned as views, torch.cat makes the only copy.
+        """
+        h, w = image.shape[2:4]
+        if h == pad_h and w == pad_w:
+            return image
+        return F.pad(image, (0, pad_w - w, 0, pad_h - h))
+
+
+class WindowPacker(object):
+    """ packs the windows of consecutive scenes into shared batches.
+
+    Scenes are bucketed by the padded shape of their windows. Windows of the scenes in the current bucket
+    wait until a full batch is ready, so small scenes with one or two windows still fill the batches.
+    A scene whose windows are all done is handed back right after its last window, and a new bucket
+    flushes the windows of the previous one. Feed the scenes sorted by bucket to pack the most.
+
+    Windows are only padded to the exact shape they would have in their own scene,
+    so packing leaves the predictions unchanged.
+    """
+
+    def __init__(self, helper, model, size_divisor=None):
+        super(WindowPacker, self).__init__()
+        self.helper = helper
+        self.model = model
+        self.size_divisor = size_divisor
+        self._key = None
+        self._pending = []
+
+    def bucket(self, wins):
+        """ padded window shape of a scene.
+        """
+        return self.helper._batch_shape(wins, self.size_divisor)
+
+    def add(self, item):
+        """ queue the windows of a scene.
+
+        Args:
+            item: dict with the normalized 'scene' and its 'wins', optionally 'run_wins', the subset of
+                the windows to run, other keys are passed through
+
+        Yields:
+            (item, prediction, win) for every finished window, then (item, None, None) once a scene is done
+        """
+        key = self.bucket(item['wins'])
+        if key != self._key:
+            for out in self.flush():
+                yield out
+            self._key = key
+        wins = item.get('run_wins', item['wins'])
+        item['stats'] = dict(num_windows=len(wins), elapsed=0., windows_per_second=0.)
+        if len(wins) == 0:
+            item.pop('scene')
+            yield item, None, None
+            return
+        item['_left'] = len(wins)
+        self._pending.extend((item, win) for win in wins)
+
+        batch_size = self.helper._inferred_batch_size.get(key, self.helper.batch_size)
+        if batch_size is None:
+            num_ready = len(self._pending)
+        else:
+            num_ready = len(self._pending) // batch_size * batch_size
+        for out in self._run(num_ready):
+            yield out
+
+    def flush(self):
+        """ run the remaining windows of the current bucket.
+        """
+        for out in self._run(len(self._pending)):
+            yield out
+
+    def _run(self, num_windows):
+        if num_windows == 0:
+            return
+        windows = self._pending[:num_windows]
+        self._pending = self._pending[num_windows:]
+        align = self.size_divisor or 32
+        for idx, pred, elapsed in self.helper._iter_batches(self.model, [(item['scene'], win) for item, win in windows],
+                                                            self._key, align):
+            item, win = windows[idx]
+            item['stats']['elapsed'] += elapsed
+            yield item, pred, win
+            item['_left'] -= 1
+            if item['_left'] == 0:
+                item.pop('scene')
+                item.pop('_left')
+                stats = item['stats']
+                stats['windows_per_second'] = stats['num_windows'] / max(stats['elapsed'], 1e-6)
+                # end of scene
+                yield item, None, None
@@ -0,0 +1,437 @@
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from infer.planner import center_crop_regions
+
+
+class Stitcher(object):
+    """ how overlapping window predictions are fused.
+
+    average: mean of the covering windows
+    gaussian: mean weighted by a gaussian centered on each window, window borders count less
+    center: each window only keeps its interior (see planner.center_crop_regions),
+        every pixel comes from a single window and no normalization is needed
+    """
+    MODES = ('average', 'gaussian', 'center')
+    _weight_cache = dict()
+
+    def __init__(self, mode, wins, input_size, sigma_scale=1. / 8):
+        super(Stitcher, self).__init__()
+        if mode not in Stitcher.MODES:
+            raise ValueError('stitch mode should be one of {}, got {}.'.format(Stitcher.MODES, mode))
+        self.mode = mode
+        self.sigma_scale = sigma_scale
+        self.keep = None
+        if mode == 'center':
+            boxes = center_crop_regions(wins, input_size)
+            self.keep = {_key(win): tuple(int(v) for v in box) for win, box in zip(wins, boxes)}
+
+    @property
+    def normalized(self):
+        """ whether the canvas has to be divided by the count map.
+        """
+        return self.mode != 'center'
+
+    def weight(self, h, w):
+        """
+
+        Returns:
+            [h, w] gaussian importance map, 1 at the center
+        """
+        key = (h, w, self.sigma_scale)
+        if key not in Stitcher._weight_cache:
+            gy = torch.arange(h, dtype=torch.float32).sub_((h - 1) / 2.).div_(h * self.sigma_scale)
+            gx = torch.arange(w, dtype=torch.float32).sub_((w - 1) / 2.).div_(w * self.sigma_scale)
+            weight = torch.exp(-0.5 * (gy.pow(2)[:, None] + gx.pow(2)[None, :]))
+            # keep window borders from vanishing, image borders are only covered by them
+            Stitcher._weight_cache[key] = weight.clamp_(min=1e-3)
+        return Stitcher._weight_cache[key]
+
+    def box(self, win):
+        if self.mode == 'center':
+            return self.keep[_key(win)]
+        return win
+
+    def __call__(self, pred, win):
+        """
+
+        Returns:
+            prediction to accumulate, its box (x1, y1, x2, y2) in image coordinates
+        """
+        if self.mode == 'gaussian':
+            return pred * self.weight(pred.size(2), pred.size(3)).to(pred.device), win
+        if self.mode == 'center':
+            x1, y1, x2, y2 = self.box(win)
+            return pred[:, :, y1 - win[1]:y2 - win[1], x1 - win[0]:x2 - win[0]], (x1, y1, x2, y2)
+        return pred, win
+
+    def count_map(self, out, wins, y0=0):
+        """ add the per-pixel weight sum of the windows into out.
+
+        Args:
+            out: [rows, W] tensor covering image rows [y0, y0 + rows)
+        """
+        y_end = y0 + out.size(0)
+        for win in wins:
+            x1, y1, x2, y2 = self.box(win)
+            a, b = max(int(y1), y0), min(int(y2), y_end)
+            if a >= b:
+                continue
+            if self.mode == 'gaussian':
+                out[a - y0:b - y0, x1:x2] += self.weight(int(win[3] - win[1]), int(win[2] - win[0]))[a - y1:b - y1]
+            else:
+                out[a - y0:b - y0, x1:x2] += 1
+        return out
+
+
+def _key(win):
+    return tuple(int(v) for v in win)
+
+
+class SlidingWinAccumulator(object):
+    """ in-place stitching canvas for sliding window inference.
+
+    Each window prediction is added into a preallocated canvas as soon as it is produced,
+    so peak memory is one canvas instead of every window output of the scene.
+    The count map (number of windows covering each pixel, or their weight sum) only depends on
+    the window layout and the stitcher, it is cached per (H, W, windows, stitch mode).
+    """
+    _count_cache = OrderedDict()
+    _count_cache_size = 8
+
+    def __init__(self, h, w, wins, dtype=torch.float32, stitch_mode='average'):
+        super(SlidingWinAccumulator, self).__init__()
+        self.h = h
+        self.w = w
+        self.wins = wins
+        self.stitcher = Stitcher(stitch_mode, wins, (h, w))
+        self.cache_key = (h, w, stitch_mode, np.ascontiguousarray(wins, dtype=np.int64).tobytes())
+        self.dtype = dtype
+        self.canvas = None
+
+    def add(self, pred, win):
+        """
+
+        Args:
+            pred: [N, #class, h, w] window prediction, already cropped to the window size
+            win: (x1, y1, x2, y2)
+        """
+        pred, box = self.stitcher(pred, win)
+        if self.canvas is None:
+            self.canvas = torch.zeros(pred.size(0), pred.size(1), self.h, self.w, dtype=self.dtype)
+        self.canvas[:, :, box[1]:box[3], box[0]:box[2]] += pred.to(self.canvas.device, self.dtype)
+
+    def count_map(self):
+        key = self.cache_key
+        if key in SlidingWinAccumulator._count_cache:
+            SlidingWinAccumulator._count_cache.move_to_end(key)
+            return SlidingWinAccumulator._count_cache[key]
+
+        count = self.stitcher.count_map(torch.zeros(self.h, self.w, dtype=torch.float32), self.wins)
+
+        SlidingWinAccumulator._count_cache[key] = count
+        while len(SlidingWinAccumulator._count_cache) > SlidingWinAccumulator._count_cache_size:
+            SlidingWinAccumulator._count_cache.popitem(last=False)
+        return count
+
+    def result(self):
+        """ normalize the canvas in place and hand it over.
+
+        Returns:
+            [N, #class, H, W] averaged prediction
+        """
+        canvas = self.canvas
+        self.canvas = None
+        if not self.stitcher.normalized:
+            return canvas
+        return canvas.div_(self.count_map())
+
+    def labels(self):
+        """ argmax of the canvas, the division by the count map is skipped since it is positive per pixel.
+
+        Returns:
+            [N, H, W] uint8 labels
+        """
+        canvas = self.canvas
+        self.canvas = None
+        return canvas.argmax(dim=1).to(torch.uint8)
+
+
+class QuantizedAccumulator(SlidingWinAccumulator):
+    """ averaged probabilities quantized to uint8.
+
+    Each window adds floor(p * 255 / count) so that the sum over the covering windows never exceeds 255,
+    the canvas ends up holding the averaged probability in [0, 255] with an error of at most count LSB.
+    """
+
+    def __init__(self, h, w, wins, stitch_mode='average'):
+        super(QuantizedAccumulator, self).__init__(h, w, wins, dtype=torch.uint8, stitch_mode=stitch_mode)
+        self._count = None
+
+    def add(self, pred, win):
+        pred, box = self.stitcher(pred, win)
+        if self.canvas is None:
+            self.canvas = torch.zeros(pred.size(0), pred.size(1), self.h, self.w, dtype=torch.uint8)
+            self._count = self.count_map()
+        scale = 255. / self._count[box[1]:box[3], box[0]:box[2]]
+        q = pred.to(self.canvas.device, torch.float32).mul_(scale).floor_().to(torch.uint8)
+        self.canvas[:, :, box[1]:box[3], box[0]:box[2]] += q
+
+    def result(self):
+        """
+
+        Returns:
+            [N, #class, H, W] uint8 averaged prediction, divide by 255 to get probabilities
+        """
+        canvas = self.canvas
+        self.canvas = None
+        return canvas
+
+
+class LabelAccumulator(SlidingWinAccumulator):
+    """ label-only stitching, a class-probability canvas is never materialized.
+
+    A running best score and its label are kept per pixel, which fuses overlapping windows
+    by max (weighted) confidence instead of averaging. Memory is 3 bytes per pixel regardless of #class.
+    """
+
+    def __init__(self, h, w, wins, stitch_mode='average'):
+        super(LabelAccumulator, self).__init__(h, w, wins, dtype=torch.float16, stitch_mode=stitch_mode)
+        self.best_score = None
+
+    def add(self, pred, win):
+        pred, win = self.stitcher(pred, win)
+        if self.canvas is None:
+            self.canvas = torch.zeros(pred.size(0), self.h, self.w, dtype=torch.uint8)
+            self.best_score = torch.full((pred.size(0), self.h, self.w), -1., dtype=self.dtype)
+        score, label = pred.to(self.canvas.device).max(dim=1)
+        score = score.to(self.dtype)
+        best_score = self.best_score[:, win[1]:win[3], win[0]:win[2]]
+        labels = self.canvas[:, win[1]:win[3], win[0]:win[2]]
+        better = score > best_score
+        best_score[better] = score[better]
+        labels[better] = label[better].to(torch.uint8)
+
+    def result(self):
+        return self.labels()
+
+    def labels(self):
+        """
+
+        Returns:
+            [N, H, W] uint8 labels
+        """
+        labels = self.canvas
+        self.canvas = None
+        self.best_score = None
+        return labels
+
+
+class MemmapAccumulator(SlidingWinAccumulator):
+    """ disk-backed canvas for scenes that do not fit into memory even at reduced precision.
+
+    The canvas is a numpy.memmap laid out as [H, W, #class], so a window touches (y2 - y1) contiguous
+    row segments and a band of rows is one contiguous block. Windows are expected in raster order,
+    dirty pages are flushed every time the windows move on to the next row band, and the final
+    normalization and argmax are done band by band. Resident memory is bounded by a few bands.
+    """
+
+    def __init__(self, h, w, wins, dtype=torch.float32, stitch_mode='average', mmap_dir=None, band_rows=512):
+        super(MemmapAccumulator, self).__init__(h, w, wins, dtype, stitch_mode)
+        self.mmap_dir = mmap_dir
+        self.band_rows = band_rows
+        self._files = []
+        self._mm = None
+        self._last_y = 0
+
+    def _memmap(self, shape, dtype):
+        # the file is unlinked on creation and released once its map is gone
+        f = tempfile.TemporaryFile(dir=self.mmap_dir)
+        self._files.append(f)
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+
+    def _bands(self):
+        for y0 in range(0, self.h, self.band_rows):
+            yield y0, min(y0 + self.band_rows, self.h)
+
+    def add(self, pred, win):
+        assert pred.size(0) == 1, 'memmap canvas holds a single image.'
+        pred, box = self.stitcher(pred, win)
+        if self.canvas is None:
+            np_dtype = np.float16 if self.dtype == torch.float16 else np.float32
+            self._mm = self._memmap((self.h, self.w, pred.size(1)), np_dtype)
+            self.canvas = torch.from_numpy(self._mm)
+        if win[1] > self._last_y:
+            # next row band of windows
+            self._mm.flush()
+            self._last_y = win[1]
+        self.canvas[box[1]:box[3], box[0]:box[2], :] += pred[0].permute(1, 2, 0).to(self.dtype)
+
+    def count_map(self):
+        count = torch.from_numpy(self._memmap((self.h, self.w), np.float32))
+        return self.stitcher.count_map(count, self.wins)
+
+    def result(self):
+        """
+
+        Returns:
+            [1, #class, H, W] averaged prediction, a view on the memmap
+        """
+        if self.stitcher.normalized:
+            count = self.count_map()
+            for y0, y1 in self._bands():
+                self.canvas[y0:y1].div_(count[y0:y1].unsqueeze(-1))
+        canvas = self.canvas
+        self.close()
+        return canvas.permute(2, 0, 1).unsqueeze(0)
+
+    def labels(self):
+        labels = torch.empty(1, self.h, self.w, dtype=torch.uint8)
+        for y0, y1 in self._bands():
+            labels[0, y0:y1] = self.canvas[y0:y1].argmax(dim=-1).to(torch.uint8)
+        self.close()
+        return labels
+
+    def close(self):
+        self.canvas = None
+        self._mm = None
+        for f in self._files:
+            f.close()
+        self._files = []
+
+
+class BandAccumulator(object):
+    """ stitching canvas that only holds the rows still overlapped by upcoming windows.
+
+    The canvas covers rows [top, top + canvas height), it grows when a window reaches below it
+    and finished rows are cut off from its top by release.
+    """
+
+    def __init__(self, h, w, wins, dtype=torch.float32, stitch_mode='average'):
+        super(BandAccumulator, self).__init__()
+        self.h = h
+        self.w = w
+        self.wins = wins
+        self.stitcher = Stitcher(stitch_mode, wins, (h, w))
+        self.dtype = dtype
+        self.top = 0
+        self.canvas = None
+
+    def add(self, pred, win):
+        pred, box = self.stitcher(pred, win)
+        if self.canvas is None:
+            self.canvas = torch.zeros(pred.size(0), pred.size(1), 0, self.w, dtype=self.dtype)
+        bottom = self.top + self.canvas.size(2)
+        if box[3] > bottom:
+            n, c = self.canvas.shape[:2]
+            self.canvas = torch.cat([self.canvas,
+                                     torch.zeros(n, c, box[3] - bottom, self.w, dtype=self.dtype)], dim=2)
+        self.canvas[:, :, box[1] - self.top:box[3] - self.top, box[0]:box[2]] += pred.to(self.dtype)
+
+    def release(self, y, return_labels=False):
+        """ cut rows [top, y) off the canvas.
+
+        Args:
+            y: first row that may still receive window predictions
+            return_labels: argmax the band instead of normalizing it
+
+        Returns:
+            [N, y - top, W] uint8 labels or [N, #class, y - top, W] averaged prediction
+        """
+        num_rows = y - self.top
+        band = self.canvas[:, :, :num_rows]
+        self.canvas = self.canvas[:, :, num_rows:].clone()
+        if return_labels:
+            band = band.argmax(dim=1).to(torch.uint8)
+        elif self.stitcher.normalized:
+            count = self.stitcher.count_map(torch.zeros(num_rows, self.w, dtype=torch.float32), self.wins, self.top)
+            band = band.div(count)
+        self.top = y
+        return band
+
+
+def upsample_labels(probs, scale, h, w, band_rows=64):
+    """ bilinear upsampling by scale followed by argmax, one band of rows at a time.
+
+    With align_corners=False an output row only depends on its two nearest input rows,
+    so each band is interpolated from its own rows plus a one-row margin and matches
+    upsampling the whole canvas at once. Only one upsampled band is alive at a time.
+
+    Args:
+        probs: [N, #class, ceil(h / scale), ceil(w / scale)] canvas
+        h, w: output size
+
+    Returns:
+        [N, h, w] uint8 labels
+    """
+    n, _, ch, _ = probs.shape
+    labels = torch.empty(n, h, w, dtype=torch.uint8)
+    for y0 in range(0, ch, band_rows):
+        y1 = min(y0 + band_rows, ch)
+        a, b = max(y0 - 1, 0), min(y1 + 1, ch)
+        band = F.interpolate(probs[:, :, a:b].float(), scale_factor=scale, mode='bilinear', align_corners=False)
+        out_y0, out_y1 = y0 * scale, min(y1 * scale, h)
+        band = band[:, :, (y0 - a) * scale:(y0 - a) * scale + out_y1 - out_y0, :w]
+        labels[:, out_y0:out_y1] = band.argmax(dim=1).to(torch.uint8)
+    return labels
+
+
+class StridedAccumulator(object):
+    """ stitches stride-s window predictions on a stride-s canvas.
+
+    Windows are given in full resolution and have to be aligned to the stride.
+    The canvas is s * s times smaller than at full resolution, labels come from a single
+    band-wise upsampling of the stitched canvas at the end.
+    """
+
+    def __init__(self, acc, stride, h, w):
+        super(StridedAccumulator, self).__init__()
+        self.acc = acc
+        self.stride = stride
+        self.h = h
+        self.w = w
+
+    def add(self, pred, win):
+        self.acc.add(pred, [v // self.stride for v in win])
+
+    def result(self):
+        """
+
+        Returns:
+            [N, #class, ceil(H / s), ceil(W / s)] prediction at the output stride
+        """
+        return self.acc.result()
+
+    def labels(self):
+        return upsample_labels(self.acc.result(), self.stride, self.h, self.w)
+
+
+OUTPUT_MODES = dict(
+    float32=lambda *args, **kwargs: SlidingWinAccumulator(*args, dtype=torch.float32, **kwargs),
+    float16=lambda *args, **kwargs: SlidingWinAccumulator(*args, dtype=torch.float16, **kwargs),
+    uint8=QuantizedAccumulator,
+    label=LabelAccumulator,
+)
+
+
+def build_accumulator(output_mode, h, w, wins, mmap_dir=None, stitch_mode='average', output_stride=1):
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError('output_mode should be one of {}, got {}.'.format(list(OUTPUT_MODES), output_mode))
+    if output_stride > 1:
+        if output_mode == 'label':
+            raise ValueError('label output mode needs full resolution predictions.')
+        if np.any(wins % output_stride):
+            raise ValueError('windows should be aligned to the output stride {}.'.format(output_stride))
+        acc = build_accumulator(output_mode, -(-h // output_stride), -(-w // output_stride), wins // output_stride,
+                                mmap_dir, stitch_mode)
+        return StridedAccumulator(acc, output_stride, h, w)
+    if mmap_dir is not None:
+        if output_mode not in ('float32', 'float16'):
+            raise ValueError('memmap canvas supports float32 and float16 output modes, got {}.'.format(output_mode))
+        return MemmapAccumulator(h, w, wins, dtype=getattr(torch, output_mode), stitch_mode=stitch_mode,
+                                 mmap_dir=mmap_dir)
+    return OUTPUT_MODES[output_mode](h, w, wins, stitch_mode=stitch_mode)
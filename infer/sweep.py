@@ -0,0 +1,57 @@
+import glob
+import os
+import re
+
+import torch
+import torch.nn as nn
+
+
+def list_checkpoints(paths, pattern='model-*.pth'):
+    """ expand directories into their checkpoints.
+
+    Args:
+        paths: checkpoint files or directories
+        pattern: checkpoint file pattern inside a directory
+
+    Returns:
+        checkpoint files, those of a directory sorted by step
+    """
+    def _step(fp):
+        m = re.search(r'(\d+)', os.path.basename(fp))
+        return int(m.group(1)) if m else -1
+
+    ckpts = []
+    for path in paths:
+        if os.path.isdir(path):
+            ckpts += sorted(glob.glob(os.path.join(path, pattern)), key=_step)
+        else:
+            ckpts.append(path)
+    return ckpts
+
+
+class SweepModel(nn.Module):
+    """ several checkpoints of the same model run on the same input batch.
+
+    The outputs are concatenated along the channel dimension, so the window batches, memory probing and
+    out-of-memory handling of the sliding window inference are shared. split recovers the per-checkpoint
+    predictions.
+    """
+
+    def __init__(self, models):
+        super(SweepModel, self).__init__()
+        self.models = nn.ModuleList(models)
+
+    def forward(self, x):
+        return torch.cat([model(x) for model in self.models], dim=1)
+
+    def split(self, pred):
+        """
+
+        Returns:
+            list of per-checkpoint predictions
+        """
+        return pred.chunk(len(self.models), dim=1)
+
+    def set_infer_output_stride(self, output_stride):
+        for model in self.models:
+            model.set_infer_output_stride(output_stride)
@@ -0,0 +1,75 @@
+import torch
+import torch.nn as nn
+
+# name: (transform, inverse) on [N, C, H, W], the inverse is applied to the model output
+TRANSFORMS = dict(
+    identity=(lambda x: x, lambda y: y),
+    hflip=(lambda x: x.flip(3), lambda y: y.flip(3)),
+    vflip=(lambda x: x.flip(2), lambda y: y.flip(2)),
+    rot90=(lambda x: x.rot90(1, (2, 3)), lambda y: y.rot90(-1, (2, 3))),
+    rot180=(lambda x: x.rot90(2, (2, 3)), lambda y: y.rot90(-2, (2, 3))),
+    rot270=(lambda x: x.rot90(3, (2, 3)), lambda y: y.rot90(-3, (2, 3))),
+    transpose=(lambda x: x.transpose(2, 3), lambda y: y.transpose(2, 3)),
+    antitranspose=(lambda x: x.rot90(2, (2, 3)).transpose(2, 3), lambda y: y.transpose(2, 3).rot90(-2, (2, 3))),
+)
+
+TTA_SETS = dict(
+    flip=('identity', 'hflip'),
+    flips=('identity', 'hflip', 'vflip'),
+    rot=('identity', 'rot90', 'rot180', 'rot270'),
+    d4=('identity', 'hflip', 'vflip', 'rot90', 'rot180', 'rot270', 'transpose', 'antitranspose'),
+)
+
+
+def parse_tta(tta):
+    """
+
+    Args:
+        tta: name of a set in TTA_SETS or comma separated transform names
+
+    Returns:
+        tuple of transform names
+    """
+    if tta in TTA_SETS:
+        return TTA_SETS[tta]
+    names = tuple(name.strip() for name in tta.split(','))
+    for name in names:
+        if name not in TRANSFORMS:
+            raise ValueError('unknown tta transform {}, should be one of {} or a set of {}.'.format(
+                name, list(TRANSFORMS), list(TTA_SETS)))
+    return names
+
+
+class TTAModel(nn.Module):
+    """ test-time augmentation in a single forward.
+
+    The augmented copies of a batch are stacked along the batch dimension, the transforms are undone on
+    the outputs on the device and the outputs are averaged. Transforms that swap H and W of a non-square
+    input cannot share a batch with the others and get a second forward.
+    """
+
+    def __init__(self, model, transforms=('identity', 'hflip')):
+        super(TTAModel, self).__init__()
+        self.model = model
+        self.transforms = parse_tta(transforms) if isinstance(transforms, str) else tuple(transforms)
+
+    def forward(self, x):
+        n = x.size(0)
+        groups = dict()
+        for name in self.transforms:
+            t = TRANSFORMS[name][0](x)
+            groups.setdefault(tuple(t.shape[2:4]), []).append((name, t))
+        out = None
+        for group in groups.values():
+            y = self.model(torch.cat([t for _, t in group], dim=0))
+            for i, (name, _) in enumerate(group):
+                y_i = TRANSFORMS[name][1](y[i * n:(i + 1) * n])
+                out = y_i.clone() if out is None else out.add_(y_i)
+        return out.div_(len(self.transforms))
+
+    def __getattr__(self, name):
+        # set_infer_output_stride, set_early_exit and the like go to the wrapped model
+        try:
+            return super(TTAModel, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.model, name)
@@ -0,0 +1,119 @@
+import logging
+import multiprocessing as mp
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger('SW-Infer')
+
+
+def _encode(name, shape, path, palette, compress_level):
+    """ write a palette PNG from a label map in shared memory, runs in a worker process.
+
+    Returns:
+        seconds spent, bytes written
+    """
+    since = time.perf_counter()
+    # the worker shares the resource tracker of the owner, which unlinks the block
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        labels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        image = Image.fromarray(labels)
+        image.putpalette(palette)
+        image.save(path, compress_level=compress_level)
+        del image, labels
+    finally:
+        shm.close()
+    return time.perf_counter() - since, os.path.getsize(path)
+
+
+class PaletteWriter(object):
+    """ writes label maps as palette-mode PNGs in a process pool.
+
+    A label map is copied once into a shared memory block, the worker reads it from there instead of
+    unpickling it. At most max_pending maps are in flight, submit blocks beyond that, so memory stays bounded
+    when encoding falls behind. The first worker error is raised by the next submit or by close.
+    """
+
+    def __init__(self, palette, num_workers=4, max_pending=8, compress_level=6):
+        """
+
+        Args:
+            palette: flat [r, g, b, r, g, b, ...] list, one triple per class
+            compress_level: zlib level of the PNGs, 0 (fastest) to 9 (smallest)
+        """
+        super(PaletteWriter, self).__init__()
+        self.palette = list(palette)
+        self.compress_level = compress_level
+        # spawn: the workers start lazily from the stitch thread, forking a process with running threads and an
+        # initialized CUDA context can deadlock the children
+        self._pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context('spawn'))
+        self._slots = threading.Semaphore(max_pending)
+        self._lock = threading.Lock()
+        self._error = None
+        self.stats = dict(images=0, pixels=0, bytes=0, encode_time=0., blocked=0.)
+        self._since = time.perf_counter()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('visualization worker failed.') from error
+
+    def submit(self, labels, path):
+        """
+
+        Args:
+            labels: [H, W] or [1, H, W] uint8 label map, numpy array or tensor
+            path: png file to write
+        """
+        self._raise()
+        labels = np.asarray(labels, dtype=np.uint8)
+        labels = labels.reshape(labels.shape[-2:])
+        since = time.perf_counter()
+        self._slots.acquire()
+        with self._lock:
+            self.stats['blocked'] += time.perf_counter() - since
+
+        shm = shared_memory.SharedMemory(create=True, size=max(labels.nbytes, 1))
+        try:
+            np.ndarray(labels.shape, dtype=np.uint8, buffer=shm.buf)[...] = labels
+            future = self._pool.submit(_encode, shm.name, labels.shape, path, self.palette, self.compress_level)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._done(f, shm, labels.size))
+
+    def _done(self, future, shm, num_pixels):
+        shm.close()
+        shm.unlink()
+        self._slots.release()
+        error = future.exception()
+        with self._lock:
+            if error is not None:
+                if self._error is None:
+                    self._error = error
+                return
+            elapsed, num_bytes = future.result()
+            self.stats['images'] += 1
+            self.stats['pixels'] += num_pixels
+            self.stats['bytes'] += num_bytes
+            self.stats['encode_time'] += elapsed
+
+    def close(self):
+        """ wait for the pending images, log the throughput and raise the first worker error.
+        """
+        self._pool.shutdown(wait=True)
+        wall = time.perf_counter() - self._since
+        s = self.stats
+        logger.info('visualization: {} images, {:.1f} MB, encode {:.1f} Mpixel/s per worker, '
+                    '{:.1f} Mpixel/s overall, submit blocked {:.2f}s'.format(
+            s['images'], s['bytes'] / 1e6, s['pixels'] / 1e6 / max(s['encode_time'], 1e-6),
+            s['pixels'] / 1e6 / max(wall, 1e-6), s['blocked']))
+        self._raise()
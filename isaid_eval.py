@@ -1,80 +1,34 @@
 import argparse
+import importlib
 import logging
+import multiprocessing as mp
+import os
+import queue
+import traceback
 import torch
 import numpy as np
 import simplecv as sc
 from data.isaid import COLOR_MAP
 from data.isaid import ImageFolderDataset
-from concurrent.futures import ProcessPoolExecutor
 from tensorboardX import SummaryWriter
 from module import farseg
-from torch.utils.data.dataloader import DataLoader
 from simplecv.api.preprocess import comm
 from simplecv.api.preprocess import segm
-from tqdm import tqdm
-from simplecv.data.preprocess import sliding_window
-
-
-class SegmSlidingWinInference(object):
-    def __init__(self):
-        super(SegmSlidingWinInference, self).__init__()
-        self._h = None
-        self._w = None
-        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-
-    def patch(self, input_size, patch_size, stride, transforms=None):
-        """ divide large image into small patches.
-
-        Returns:
-
-        """
-        self.wins = sliding_window(input_size, patch_size, stride)
-        self.transforms = transforms
-        return self
-
-    def merge(self, out_list):
-        pred_list, win_list = list(zip(*out_list))
-        num_classes = pred_list[0].size(1)
-        res_img = torch.zeros(pred_list[0].size(0), num_classes, self._h, self._w, dtype=torch.float32)
-        res_count = torch.zeros(self._h, self._w, dtype=torch.float32)
-
-        for pred, win in zip(pred_list, win_list):
-            res_count[win[1]:win[3], win[0]: win[2]] += 1
-            res_img[:, :, win[1]:win[3], win[0]: win[2]] += pred.cpu()
-
-        avg_res_img = res_img / res_count
-
-        return avg_res_img
-
-    def forward(self, model, image_np, **kwargs):
-        assert self.wins is not None, 'patch must be performed before forward.'
-        # set the image height and width
-        self._h, self._w, _ = image_np.shape
-        return self._forward(model, image_np, **kwargs)
-
-    def _forward(self, model, image_np, **kwargs):
-        self.device = kwargs.get('device', self.device)
-        size_divisor = kwargs.get('size_divisor', None)
-        assert self.wins is not None, 'patch must be performed before forward.'
-        out_list = []
-        for win in tqdm(self.wins):
-            x1, y1, x2, y2 = win
-            image = image_np[y1:y2, x1:x2, :].astype(np.float32)
-            if self.transforms is not None:
-                image = self.transforms(image)
-            h, w = image.shape[2:4]
-            if size_divisor is not None:
-                image = sc.preprocess.function.th_divisible_pad(image, size_divisor)
-            image = image.to(self.device)
-            with torch.no_grad():
-                out = model(image)
-            if size_divisor is not None:
-                out = out[:, :, :h, :w]
-            out_list.append((out.cpu(), win))
-            torch.cuda.empty_cache()
-        self.wins = None
-
-        return self.merge(out_list)
+from infer.compiled import CompiledModel
+from infer.journal import EvalJournal
+from infer.journal import settings_key
+from infer.metric import ConfusionMatrix
+from infer.quant import load_quantized
+from infer.pipeline import Pipeline
+from infer.pipeline import Stage
+from infer.shard import shard_by_pixels
+from infer.sliding_win import SegmSlidingWinInference
+from infer.sliding_win import WindowPacker
+from infer.stitch import build_accumulator
+from infer.sweep import SweepModel
+from infer.sweep import list_checkpoints
+from infer.tta import parse_tta
+from infer.viz import PaletteWriter
 
 
 parser = argparse.ArgumentParser()
@@ -92,38 +46,265 @@ parser.add_argument('--log_dir', default=None, type=str,
                     help='path to log')
 parser.add_argument('--patch_size', default=896, type=int,
                     help='patch size')
+parser.add_argument('--batch_size', default=None, type=int,
+                    help='number of windows per forward, inferred from free memory if not given')
+parser.add_argument('--output_mode', default='float32', type=str,
+                    choices=('float32', 'float16', 'uint8', 'label'),
+                    help='precision of the stitching canvas, label keeps a running argmax only')
+parser.add_argument('--mmap_dir', default=None, type=str,
+                    help='back the stitching canvas by memory-mapped files in this dir')
+parser.add_argument('--scene_on_device', action='store_true',
+                    help='normalize the whole image once on the model device')
+parser.add_argument('--min_overlap', default=None, type=int,
+                    help='plan the fewest windows with at least this overlap instead of stride 512')
+parser.add_argument('--halo', default=None, type=int,
+                    help='plan the fewest windows with this context on every inner side')
+parser.add_argument('--stitch_mode', default='average', type=str,
+                    choices=('average', 'gaussian', 'center'),
+                    help='how overlapping windows are fused')
+parser.add_argument('--output_stride', default=1, type=int, choices=(1, 4),
+                    help='4: stitch stride-4 predictions and upsample once per scene')
+parser.add_argument('--num_decode_workers', default=4, type=int,
+                    help='number of threads decoding images and masks')
+parser.add_argument('--queue_size', default=2, type=int,
+                    help='capacity of the queues between pipeline stages')
+parser.add_argument('--num_procs', default=1, type=int,
+                    help='number of evaluation processes, each with its own model replica and a shard of the scenes')
+parser.add_argument('--num_threads', default=None, type=int,
+                    help='intra-op threads per evaluation process, cpu count / num_procs if not given')
+parser.add_argument('--journal', default=None, type=str,
+                    help='append-only journal of finished scenes, scenes already in it are skipped')
+parser.add_argument('--journal_labels', action='store_true',
+                    help='also store compressed label predictions next to the journal')
+parser.add_argument('--rescore', action='store_true',
+                    help='recompute the metric from the labels in the journal without running the model')
+parser.add_argument('--pack_windows', action='store_true',
+                    help='sort scenes into buckets of equal window shape and pack windows of several scenes '
+                         'into one batch')
+parser.add_argument('--viz_compress_level', default=6, type=int,
+                    help='zlib level of the visualization PNGs, 0 (fastest) to 9 (smallest)')
+parser.add_argument('--viz_queue_size', default=8, type=int,
+                    help='maximum number of visualizations waiting to be encoded')
+parser.add_argument('--scout', action='store_true',
+                    help='run a downsampled pass first and skip the full resolution windows without foreground')
+parser.add_argument('--scout_scale', default=0.25, type=float,
+                    help='downsampling factor of the scout pass')
+parser.add_argument('--scout_threshold', default=0.1, type=float,
+                    help='foreground probability of the scout pass above which a window is run')
+parser.add_argument('--scout_margin', default=64, type=int,
+                    help='recall margin, foreground this many pixels around a window also keeps it')
+parser.add_argument('--scout_verify', action='store_true',
+                    help='run every window anyway and report the mIoU delta of skipping against the exhaustive run')
+parser.add_argument('--early_exit', default=None, type=float,
+                    help='FarSegPP: windows with max objectness below this threshold skip the semantic decoder, '
+                         'needs ParallelDecoder or ObjSegCascadeDecoder, SegObjCascadeDecoder computes the '
+                         'objectness from the semantic decoder and is not supported')
+parser.add_argument('--deploy', action='store_true',
+                    help='fold BatchNorm into the convs, merge the 1x1 convs of the scene relation and drop dropout')
+parser.add_argument('--precision', default='fp32', type=str, choices=('fp32', 'bf16', 'fp16'),
+                    help='autocast precision of the model, fp16 runs as bf16 on the cpu')
+parser.add_argument('--precision_guard', default=0, type=int,
+                    help='windows per scene also run in fp32 to check the label disagreement of --precision')
+parser.add_argument('--precision_guard_threshold', default=0.01, type=float,
+                    help='label disagreement with fp32 above which the guard warns')
+parser.add_argument('--channels_last', action='store_true',
+                    help='convert the weights, the scenes and the window batches to channels last (NHWC)')
+parser.add_argument('--compile', action='store_true',
+                    help='torch.compile the model, one graph per window shape')
+parser.add_argument('--compile_mode', default=None, type=str,
+                    help='mode of torch.compile, e.g. max-autotune')
+parser.add_argument('--compile_cache_dir', default=None, type=str,
+                    help='compile cache kept across runs, later runs load it instead of compiling again')
+parser.add_argument('--quantized', default=None, type=str,
+                    help='int8 model from quantize.py to evaluate on the cpu instead of ckpt_path')
+parser.add_argument('--tta', default=None, type=str,
+                    help='test-time augmentation, flip, flips, rot, d4 or comma separated transforms of infer.tta')
+parser.add_argument('--shared_tile', default=None, type=int,
+                    help='encode blocks of neighbouring windows as tiles of at most this size and run only the '
+                         'head per window, patch size and stride should be multiples of 32')
+parser.add_argument('--shared_halo', default=128, type=int,
+                    help='context around the windows of a shared tile')
+parser.add_argument('--sweep', default=None, type=str, nargs='+',
+                    help='checkpoints or directories of model-*.pth to evaluate together instead of ckpt_path, '
+                         'each scene is decoded once and every window batch goes through all of them')
 args = parser.parse_args()
 
-logger = logging.getLogger('SW-Infer')
-logger.setLevel(logging.INFO)
+# 提前退出需要先计算目标性的解码器，在解析参数时检查，而不是在运行中途失败
+EARLY_EXIT_DECODERS = ('ParallelDecoder', 'ObjSegCascadeDecoder')
 
 
-def run():
-    '''
+def _check_early_exit():
+    if args.early_exit is None:
+        return
+    model_cfg = importlib.import_module('configs.{}'.format(args.config_path)).config['model']
+    decoder_arch = model_cfg['params'].get('decoder_arch', 'ObjSegCascadeDecoder')
+    if model_cfg['type'] != 'FarSegPP' or decoder_arch not in EARLY_EXIT_DECODERS:
+        parser.error('--early_exit needs FarSegPP with {}, {} uses {}.'.format(
+            ' or '.join(EARLY_EXIT_DECODERS), args.config_path,
+            decoder_arch if model_cfg['type'] == 'FarSegPP' else model_cfg['type']))
 
 
+_check_early_exit()
 
+logger = logging.getLogger('SW-Infer')
+logger.setLevel(logging.INFO)
 
 
-    :return:
-    '''
-    model, global_step = sc.infer_tool.build_and_load_from_file(args.config_path, args.ckpt_path)
-    model.to(torch.device('cuda'))
-    # 首先通过infer_tool模块中的build_and_load_from_file()方法加载模型和全局步数。然后将模型移动到GPU上。
-    segm_helper = SegmSlidingWinInference()
+def checkpoint_paths():
+    if args.quantized is not None:
+        return [args.quantized]
+    if args.sweep is not None:
+        return list_checkpoints(args.sweep)
+    return [args.ckpt_path]
+
+
+def open_journal():
+    """ journal of this checkpoint and these inference settings, None if --journal is not given.
+    """
+    if args.journal is None:
+        return None
+    if args.sweep is not None:
+        raise ValueError('--journal is keyed by a single checkpoint and cannot be used with --sweep.')
+    settings = dict(config_path=args.config_path,
+                    patch_size=args.patch_size,
+                    stride=512,
+                    output_mode=args.output_mode,
+                    min_overlap=args.min_overlap,
+                    halo=args.halo,
+                    stitch_mode=args.stitch_mode,
+                    output_stride=args.output_stride)
+    if args.deploy:
+        settings.update(deploy=True)
+    if args.early_exit is not None:
+        settings.update(early_exit=args.early_exit)
+    if args.precision != 'fp32':
+        settings.update(precision=args.precision)
+    if args.tta is not None:
+        settings.update(tta=list(parse_tta(args.tta)))
+    if args.shared_tile is not None:
+        settings.update(shared_tile=args.shared_tile, shared_halo=args.shared_halo)
+    if args.scout:
+        settings.update(scout_scale=args.scout_scale, scout_threshold=args.scout_threshold,
+                        scout_margin=args.scout_margin, scout_verify=args.scout_verify)
+    return EvalJournal(args.journal, settings_key(args.quantized or args.ckpt_path, settings),
+                       save_labels=args.journal_labels or args.rescore)
+
+
+def pending_scenes(dataset, indices, journal, miou_op):
+    """ drop the scenes finished in the journal, their confusion matrices go into miou_op.
+
+    Returns:
+        indices still to evaluate
+    """
+    if journal is None:
+        return list(indices)
+    pending = []
+    for idx in indices:
+        fp = dataset.fp_list[idx]
+        if not journal.done(fp):
+            pending.append(idx)
+        elif args.rescore:
+            # 使用缓存的预测结果重新计算指标，不运行模型
+            _, mask, _ = dataset[idx]
+            if mask is not None:
+                miou_op.forward(mask, journal.labels(fp))
+        else:
+            cm = journal.confusion_matrix(fp)
+            if cm is not None:
+                miou_op.add(torch.from_numpy(cm))
+    logger.info('{} scenes from the journal, {} to evaluate'.format(len(indices) - len(pending), len(pending)))
+    return pending
+
+
+def evaluate(indices=None, device=None, num_viz_workers=4):
+    """ run the sliding window evaluation over a subset of the scenes.
+
+    Args:
+        indices: scene indices into ImageFolderDataset, all scenes if None
+        device: model device, default is cuda if available else cpu
+        num_viz_workers: number of processes writing the visualizations
+
+    Returns:
+        list of (ConfusionMatrix of the scenes, global step), one per checkpoint
+    """
+    if args.shared_tile is not None and (args.sweep is not None or args.pack_windows or args.tta is not None):
+        raise ValueError('--shared_tile cannot be combined with --sweep, --pack_windows or --tta.')
+    if args.quantized is not None and (args.sweep is not None or args.deploy or args.early_exit is not None
+                                       or args.precision != 'fp32' or args.channels_last):
+        raise ValueError('--quantized cannot be combined with --sweep, --deploy, --early_exit, --precision or '
+                         '--channels_last.')
+    if args.compile and (args.quantized is not None or args.shared_tile is not None):
+        raise ValueError('--compile cannot be combined with --quantized or --shared_tile.')
+    models, global_steps = [], []
+    for ckpt_path in checkpoint_paths():
+        if args.quantized is not None:
+            # int8模型只能在cpu上运行，输出步幅在量化时已固定
+            model, meta = load_quantized(ckpt_path)
+            if meta['output_stride'] != args.output_stride:
+                raise ValueError('{} was quantized with output stride {}, got --output_stride {}.'.format(
+                    args.quantized, meta['output_stride'], args.output_stride))
+            global_step = meta['global_step']
+            device = torch.device('cpu')
+        else:
+            model, global_step = sc.infer_tool.build_and_load_from_file(args.config_path, ckpt_path)
+        if args.deploy:
+            model.to_deploy()
+        if args.channels_last:
+            model.set_memory_format(torch.channels_last)
+        models.append(model)
+        global_steps.append(global_step)
+    # 多个检查点共享同一批窗口，输出沿通道维拼接
+    model = models[0] if len(models) == 1 else SweepModel(models)
+    segm_helper = SegmSlidingWinInference(batch_size=args.batch_size,
+                                          output_mode=args.output_mode,
+                                          mmap_dir=args.mmap_dir,
+                                          scene_on_device=args.scene_on_device,
+                                          min_overlap=args.min_overlap,
+                                          halo=args.halo,
+                                          stitch_mode=args.stitch_mode,
+                                          output_stride=args.output_stride,
+                                          tta=args.tta,
+                                          shared_tile=args.shared_tile,
+                                          shared_halo=args.shared_halo,
+                                          precision=args.precision,
+                                          channels_last=args.channels_last)
     # 创建SegmSlidingWinInference()对象，用于进行分割推断。
+    if device is not None:
+        segm_helper.device = device
+    model.to(segm_helper.device)
+    if args.output_stride > 1 and args.quantized is None:
+        model.set_infer_output_stride(args.output_stride)
+    if args.early_exit is not None:
+        # 先计算目标性，低于阈值的窗口直接输出背景
+        for m in models:
+            m.set_early_exit(args.early_exit)
+    if args.compile:
+        # 推断设置全部生效后再编译，之后每种窗口尺寸只编译一次
+        model = CompiledModel(model, cache_dir=args.compile_cache_dir, mode=args.compile_mode)
+    # 首先通过infer_tool模块中的build_and_load_from_file()方法加载模型和全局步数。然后将模型移动到GPU上。
 
-    ppe = ProcessPoolExecutor(max_workers=4)
-    # 使用ProcessPoolExecutor创建进程池，最大工作线程数设置为4。
     dataset = ImageFolderDataset(image_dir=args.image_dir, mask_dir=args.mask_dir)
     # 创建图像文件夹数据集ImageFolderDataset，传入图像目录和掩码目录。
     palette = np.asarray(list(COLOR_MAP.values())).reshape((-1,)).tolist()
     # 创建图像文件夹数据集ImageFolderDataset，传入图像目录和掩码目录。
-    viz_op = sc.viz.VisualizeSegmm(args.vis_dir, palette=palette)
-    # 创建可视化操作对象viz_op，用于保存可视化结果。
-
-    miou_op = sc.metric.NPmIoU(num_classes=16, logdir=args.log_dir)
-    # 创建混淆矩阵计算操作对象miou_op，传入类别数为16。
+    viz_writer = PaletteWriter(palette, num_workers=num_viz_workers, max_pending=args.viz_queue_size,
+                               compress_level=args.viz_compress_level)
+    # 创建可视化写入对象viz_writer，通过共享内存把标签图交给进程池编码为调色板PNG，排队数量有上限。
+    if len(models) == 1:
+        vis_dirs = [args.vis_dir]
+    else:
+        # 每个检查点的可视化结果保存在以global_step命名的子目录中
+        vis_dirs = [os.path.join(args.vis_dir, str(global_step)) for global_step in global_steps]
+    for vis_dir in vis_dirs:
+        os.makedirs(vis_dir, exist_ok=True)
+
+    miou_ops = [ConfusionMatrix(num_classes=16, ignore_index=255) for _ in models]
+    # 创建混淆矩阵计算操作对象miou_op，传入类别数为16，在拼接画布所在的设备上逐行带累加。
+    journal = open_journal()
+    # 已记录在日志中的场景直接使用其混淆矩阵，不再推理
+    if indices is None:
+        indices = range(len(dataset))
+    indices = pending_scenes(dataset, indices, journal, miou_ops[0])
 
     image_trans = comm.Compose([
         # 定义图像数据转换操作image_trans，包括将图像转为张量、均值标准化、自定义操作等。
@@ -132,40 +313,254 @@ def run():
         comm.CustomOp(lambda x: x.unsqueeze(0))
     ])
 
-    for idx, blob in enumerate(
-        # 遍历数据集，对每个图像进行推断和评估操作。首先获取图像、掩码和文件名等信息，然后根据图像大小进行推断，得到预测结果out。
+    segm_helper.transforms = image_trans
+    accs = dict()
+    # scout_verify: 不跳过窗口的完整结果，用于计算跳过窗口带来的mIoU变化
+    full_accs = dict()
+    full_miou_ops = [ConfusionMatrix(num_classes=16, ignore_index=255) for _ in models]
+    scout_stats = dict(windows=0, skipped=0)
+    guard_stats = dict(pixels=0, disagree=0)
 
+    def decode_op(idx):
+        # 读取图像和掩码，去除掩码的颜色映射
+        yield idx, dataset[idx]
 
-
-            DataLoader(dataset, 1, shuffle=False, pin_memory=True, num_workers=4, collate_fn=lambda x: x)):
-        image, mask, filename = blob[0]
-
+    def prepare_op(blob):
+        idx, (image, mask, filename) = blob
         h, w = image.shape[:2]
         logging.info('Progress - [{} / {}] size = ({}, {})'.format(idx + 1, len(dataset), h, w))
-        seg_helper = segm_helper.patch((h, w), patch_size=(args.patch_size, args.patch_size), stride=512,
-                                       transforms=image_trans)
+        wins = segm_helper.make_wins((h, w), patch_size=(args.patch_size, args.patch_size), stride=512)
+        yield dict(scene=segm_helper.prepare_scene(image), wins=wins, h=h, w=w, mask=mask, filename=filename,
+                   fp=dataset.fp_list[idx])
+
+    def scout_op(item):
+        # 低分辨率预测整幅场景，只在可能存在前景的窗口上运行全分辨率推理
+        if args.scout:
+            keep = segm_helper.scout(model, item['scene'], item['wins'], scale=args.scout_scale,
+                                     threshold=args.scout_threshold, margin=args.scout_margin, size_divisor=32)
+            item['scout_stats'] = segm_helper.stats['scout']
+            scout_stats['windows'] += len(keep)
+            scout_stats['skipped'] += int((~keep).sum())
+            item['kept'] = set(tuple(int(v) for v in win) for win in item['wins'][keep])
+            if not args.scout_verify:
+                item['run_wins'] = item['wins'][keep]
+        return item
+
+    # 编码器在包含多个窗口的图块上只运行一次，每个窗口只运行head
+    iter_outputs = segm_helper.iter_outputs if args.shared_tile is None else segm_helper.iter_outputs_shared
+
+    def guard_op(item):
+        # 抽样窗口同时以fp32运行，比较低精度推理的标签
+        if args.precision_guard > 0:
+            pixels, disagree = segm_helper.precision_guard(model, item['scene'], item['wins'],
+                                                           num_windows=args.precision_guard,
+                                                           threshold=args.precision_guard_threshold, size_divisor=32)
+            guard_stats['pixels'] += pixels
+            guard_stats['disagree'] += disagree
+        return item
+
+    def model_op(item):
+        scout_op(guard_op(item))
+        for pred, win in iter_outputs(model, item['scene'], item.get('run_wins', item['wins']), size_divisor=32):
+            yield item, pred, win
+        item.pop('scene')
+        item['stats'] = dict(segm_helper.stats)
+        # end of scene
+        yield item, None, None
+
+    model_stage = Stage('model', model_op)
+    if args.pack_windows:
+        # 按窗口尺寸对场景分桶排序，多个小场景的窗口打包进同一个batch
+        packer = WindowPacker(segm_helper, model, size_divisor=32)
+
+        def bucket(idx):
+            size = dataset.image_size(idx)
+            return packer.bucket(segm_helper.make_wins(size, patch_size=(args.patch_size, args.patch_size),
+                                                       stride=512))
+
+        indices = sorted(indices, key=bucket)
+        model_stage = Stage('model', lambda item: packer.add(scout_op(guard_op(item))), flush=packer.flush)
+
+    def add_op(scene_accs, item, preds, win):
+        if item['filename'] not in scene_accs:
+            scene_accs[item['filename']] = [build_accumulator(segm_helper.output_mode, item['h'], item['w'],
+                                                              item['wins'], segm_helper.mmap_dir,
+                                                              segm_helper.stitch_mode, segm_helper.output_stride)
+                                            for _ in models]
+        for acc, p in zip(scene_accs[item['filename']], preds):
+            acc.add(p, win)
+
+    def labels_op(scene_accs, item):
+        # 未运行任何窗口的场景全部为背景
+        scene_accs = scene_accs.pop(item['filename'], None)
+        if scene_accs is None:
+            return [torch.zeros(1, item['h'], item['w'], dtype=torch.uint8) for _ in models]
+        return [acc.labels() for acc in scene_accs]
+
+    def stitch_op(blob):
+        item, pred, win = blob
+        if pred is not None:
+            preds = model.split(pred) if len(models) > 1 else (pred,)
+            if 'kept' not in item or tuple(int(v) for v in win) in item['kept']:
+                add_op(accs, item, preds, win)
+            if args.scout_verify:
+                add_op(full_accs, item, preds, win)
+            return ()
+        if 'kept' in item and segm_helper.output_mode != 'label':
+            # 跳过的窗口以one-hot背景参与平均，重叠区域的平均仍是概率；label模式取最大得分，未覆盖处本就是背景
+            for win in item['wins']:
+                if tuple(int(v) for v in win) not in item['kept']:
+                    # 每个模型一个张量，uint8模式的累加器会原地缩放输入
+                    add_op(accs, item, [segm_helper.background_output(win, len(COLOR_MAP)) for _ in models], win)
+        if args.scout_verify and item['mask'] is not None:
+            for out, full_miou_op in zip(labels_op(full_accs, item), full_miou_ops):
+                full_miou_op.forward(item['mask'], out)
+        for out, miou_op, vis_dir in zip(labels_op(accs, item), miou_ops, vis_dirs):
+            cm = None
+            if item['mask'] is not None:
+                #  将预测结果转为类别标签，如果存在掩码，则使用混淆矩阵计算操作对象计算mIoU。
+                cm = miou_op.forward(item['mask'], out).cpu()
+            if journal is not None:
+                # 记录该场景的混淆矩阵和耗时
+                timing = dict(elapsed=item['stats']['elapsed'], windows_per_second=item['stats']['windows_per_second'])
+                if 'scout_stats' in item:
+                    timing.update(scout_elapsed=item['scout_stats']['elapsed'])
+                journal.record(item['fp'], cm, out, **timing)
+            viz_writer.submit(out.numpy(), os.path.join(vis_dir, item['filename']))
+            #  使用进程池异步提交可视化操作和结果保存，队列已满时等待。
+        return ()
+
+    # 解码、窗口准备、模型推理、拼接与指标计算四个阶段通过有界队列并行执行
+    pipeline = Pipeline([
+        Stage('decode', decode_op, num_workers=args.num_decode_workers),
+        Stage('prepare', prepare_op),
+        model_stage,
+        Stage('stitch', stitch_op),
+    ], maxsize=args.queue_size)
+    for _ in pipeline.run(indices):
+        pass
+    pipeline.log_stats()
+    if args.scout:
+        logger.info('scout: skipped {} / {} windows ({:.1%})'.format(
+            scout_stats['skipped'], scout_stats['windows'], scout_stats['skipped'] / max(scout_stats['windows'], 1)))
+    if args.precision_guard > 0:
+        logger.info('precision guard: {} labels disagree with fp32 on {:.4%} of {} sampled pixels'.format(
+            args.precision, guard_stats['disagree'] / max(guard_stats['pixels'], 1), guard_stats['pixels']))
+    if args.early_exit is not None:
+        for m, global_step in zip(models, global_steps):
+            logger.info('early exit: global step = {}, {} / {} windows exited, max objectness histogram = {}'.format(
+                global_step, m.exit_stats['exited'], m.exit_stats['windows'], m.exit_stats['max_objectness_hist']))
+    if args.scout_verify:
+        for miou_op, full_miou_op, global_step in zip(miou_ops, full_miou_ops, global_steps):
+            miou, full_miou = np.nanmean(miou_op.ious()), np.nanmean(full_miou_op.ious())
+            logger.info('scout: global step = {}, mIoU = {:.5f}, exhaustive mIoU = {:.5f}, delta = {:+.5f}'.format(
+                global_step, miou, full_miou, miou - full_miou))
+    if args.compile:
+        model.save_cache()
+    viz_writer.close()
+    #  等待可视化写入完成并关闭进程池
+    return list(zip(miou_ops, global_steps))
+
+
+def _eval_worker(rank, indices, num_threads, results):
+    """ entry of an evaluation process, the confusion matrix of its shard is sent back through results.
+    """
+    logging.basicConfig(level=logging.INFO)
+    torch.set_num_threads(num_threads)
+    device = None
+    if torch.cuda.is_available():
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+    try:
+        results.put((rank, [(miou_op.total.numpy(), global_step)
+                            for miou_op, global_step in evaluate(indices, device, num_viz_workers=1)], None))
+    except BaseException:
+        results.put((rank, None, traceback.format_exc()))
+        raise
+
+
+def evaluate_sharded(num_procs, num_threads=None):
+    """ run evaluate in num_procs processes, each with its own model replica and num_threads intra-op threads.
+
+    Scenes are sharded by pixel count. Confusion matrices are integer counts, so their sum does not
+    depend on the sharding and the mIoU is the same as in a single process.
+
+    Returns:
+        list of (ConfusionMatrix over all scenes, global step), one per checkpoint
+    """
+    if num_threads is None:
+        num_threads = max(mp.cpu_count() // num_procs, 1)
+    dataset = ImageFolderDataset(image_dir=args.image_dir, mask_dir=args.mask_dir)
+    miou_ops = [ConfusionMatrix(num_classes=16, ignore_index=255) for _ in checkpoint_paths()]
+    global_steps = [None] * len(miou_ops)
+    indices = pending_scenes(dataset, range(len(dataset)), open_journal(), miou_ops[0])
+    shards, loads = shard_by_pixels([dataset.image_size(i) for i in indices], num_procs)
+    shards = [[indices[i] for i in shard] for shard in shards]
+    for rank, (shard, load) in enumerate(zip(shards, loads)):
+        logger.info('shard {}: {} scenes, {:.1f} Mpixels'.format(rank, len(shard), load / 1e6))
+
+    # spawn: the children do not inherit the OpenMP state of the parent
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_eval_worker, args=(rank, shard, num_threads, results), name='eval-{}'.format(rank))
+             for rank, shard in enumerate(shards)]
+    for p in procs:
+        p.start()
+
+    done = set()
+    try:
+        while len(done) < len(procs):
+            try:
+                rank, outputs, error = results.get(timeout=1.)
+            except queue.Empty:
+                dead = [p.name for p in procs if p.exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError('evaluation process {} died.'.format(', '.join(dead)))
+                continue
+            if error is not None:
+                raise RuntimeError('evaluation process {} failed:\n{}'.format(rank, error))
+            for k, (cm, global_step) in enumerate(outputs):
+                miou_ops[k].add(torch.from_numpy(cm))
+                global_steps[k] = global_step
+            done.add(rank)
+    finally:
+        for p in procs:
+            if p.is_alive() and len(done) < len(procs):
+                p.terminate()
+            p.join()
+    return list(zip(miou_ops, global_steps))
+
+
+def run():
+    '''
+
 
-        out = seg_helper.forward(model, image, size_divisor=32)
 
-        out = out.argmax(dim=1)
 
-        if mask is not None:
-            #  将预测结果转为类别标签，如果存在掩码，则使用混淆矩阵计算操作对象计算mIoU。
 
-            miou_op.forward(mask, out)
-        ppe.submit(viz_op, out.numpy(), filename)
-        #  使用进程池异步提交可视化操作和结果保存。
-    ppe.shutdown()
-    #  关闭进程池，获取mIoU指标结果。
-    ious, miou = miou_op.summary()
+    :return:
+    '''
+    if args.num_procs > 1:
+        results = evaluate_sharded(args.num_procs, args.num_threads)
+    else:
+        if args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
+        results = evaluate()
 
     # tensorboard
     sw = SummaryWriter(logdir=args.log_dir)
-    # 将结果写入Tensorboard，包括整体mIoU、前景mIoU、每个类别的IoU等信息。
-    sw.add_scalar('eval-miou/miou', miou, global_step=global_step)
-    sw.add_scalar('eval-miou/miou-fg', ious[1:].mean(), global_step=global_step)
-    for name, iou in zip(list(COLOR_MAP.keys()), ious):
-        sw.add_scalar('eval-ious/{}'.format(name), iou, global_step=global_step)
+    for miou_op, global_step in results:
+        # 获取mIoU指标结果。
+        logger.info('global step = {}'.format(global_step))
+        # IoU表写入log_dir，多个检查点时写入以global_step命名的子目录
+        log_dir = args.log_dir
+        if len(results) > 1 and log_dir is not None:
+            log_dir = os.path.join(log_dir, str(global_step))
+        ious, miou = miou_op.summary(log_dir=log_dir)
+        # 将结果写入Tensorboard，包括整体mIoU、前景mIoU、每个类别的IoU等信息。
+        sw.add_scalar('eval-miou/miou', miou, global_step=global_step)
+        sw.add_scalar('eval-miou/miou-fg', ious[1:].mean(), global_step=global_step)
+        for name, iou in zip(list(COLOR_MAP.keys()), ious):
+            sw.add_scalar('eval-ious/{}'.format(name), iou, global_step=global_step)
 
     sw.close()
 
@@ -42,7 +42,8 @@ def _softmax_focal_loss(y_pred, y_true, ignore_index: int = 255, gamma: float =
 
 
 def cosine_annealing(lower_bound, upper_bound, _t, _t_max):
-    return upper_bound + 0.5 * (lower_bound - upper_bound) * (math.cos(math.pi * _t / _t_max) + 1)
+    # _t may be a tensor on the device, torch.cos keeps it there
+    return upper_bound + 0.5 * (lower_bound - upper_bound) * (torch.cos(math.pi * torch.as_tensor(_t) / _t_max) + 1)
 
 
 def annealing_softmax_focal_loss(y_pred,
@@ -72,10 +73,8 @@ def annealing_softmax_focal_loss(y_pred,
         scale = 1.
         if normalize:
             scale = losses.sum() / (losses * modulating_factor).sum()
-            if t > t_max:
-                scale = scale
-            else:
-                scale = cosine_annealing(1., scale, t, t_max)
+            # the annealing reaches scale at t_max, clamping the step avoids a branch on the step tensor
+            scale = cosine_annealing(1., scale, torch.as_tensor(t).clamp(max=t_max), t_max)
 
     losses = scale * (losses * modulating_factor).sum() / (valid_mask.sum() + EPS)
     return losses
@@ -108,10 +107,8 @@ def sync_annealing_softmax_focal_loss(y_pred,
 
         scale = ce_foc_sum[0] / ce_foc_sum[1]
 
-        if t > t_max:
-            scale = scale
-        else:
-            scale = cosine_annealing(1., scale, t, t_max)
+        # the annealing reaches scale at t_max, clamping the step avoids a branch on the step tensor
+        scale = cosine_annealing(1., scale, torch.as_tensor(t).clamp(max=t_max), t_max)
 
     losses = scale * foc_losses.sum() / (valid_mask.sum() + EPS)
     return losses
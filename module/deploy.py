@@ -0,0 +1,77 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+_DROPOUT = (nn.Dropout, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout)
+
+# (conv, bn) attribute pairs of the ResNet stem and blocks, forward calls the bn right after its conv
+_CONV_BN_ATTRS = dict(
+    ResNet=(('conv1', 'bn1'),),
+    BasicBlock=(('conv1', 'bn1'), ('conv2', 'bn2')),
+    Bottleneck=(('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')),
+)
+
+
+def fold_bn(module):
+    """ fold every BatchNorm2d that directly follows a Conv2d into the conv.
+
+    The pairs are the adjacent Conv2d, BatchNorm2d layers of an nn.Sequential and the convK, bnK attributes
+    of the ResNet stem and of BasicBlock and Bottleneck. The BatchNorm2d is replaced by nn.Identity so that
+    the indices of the other layers, and with them ConvBlock and the like, stay as they are. Works in place
+    on a module in eval mode.
+
+    Returns:
+        number of folded pairs
+    """
+    num_folded = 0
+    for m in module.modules():
+        for conv_name, bn_name in _CONV_BN_ATTRS.get(type(m).__name__, ()):
+            conv, bn = getattr(m, conv_name, None), getattr(m, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(m, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(m, bn_name, nn.Identity())
+                num_folded += 1
+        if not isinstance(m, nn.Sequential):
+            continue
+        for i in range(len(m) - 1):
+            if isinstance(m[i], nn.Conv2d) and isinstance(m[i + 1], nn.BatchNorm2d):
+                m[i] = fuse_conv_bn_eval(m[i], m[i + 1])
+                m[i + 1] = nn.Identity()
+                num_folded += 1
+    return num_folded
+
+
+def remove_dropout(module):
+    """ replace every dropout layer by nn.Identity, in place.
+
+    Returns:
+        number of removed layers
+    """
+    num_removed = 0
+    for m in list(module.modules()):
+        for name, child in m.named_children():
+            if isinstance(child, _DROPOUT):
+                setattr(m, name, nn.Identity())
+                num_removed += 1
+    return num_removed
+
+
+def merge_pointwise(blocks):
+    """ merge [conv 1x1, nn.Identity, ReLU] blocks that read the same input into a single wider conv.
+
+    Args:
+        blocks: BN-folded nn.Sequential blocks with the same input channels
+
+    Returns:
+        nn.Sequential(conv, ReLU), its output is the channel concatenation of the outputs of blocks
+    """
+    convs = [block[0] for block in blocks]
+    for block, conv in zip(blocks, convs):
+        if conv.kernel_size != (1, 1) or any(not isinstance(m, (nn.Identity, nn.ReLU)) for m in block[1:]):
+            raise ValueError('only BN-folded 1x1 conv + ReLU blocks can be merged, got {}.'.format(block))
+    merged = nn.Conv2d(convs[0].in_channels, sum(conv.out_channels for conv in convs), 1).to(convs[0].weight)
+    with torch.no_grad():
+        merged.weight.copy_(torch.cat([conv.weight for conv in convs], dim=0))
+        merged.bias.copy_(torch.cat([conv.bias if conv.bias is not None else conv.weight.new_zeros(conv.out_channels)
+                                     for conv in convs], dim=0))
+    return nn.Sequential(merged, nn.ReLU(True))
@@ -10,6 +10,9 @@ import math
 from module.loss import softmax_focalloss
 from module.loss import annealing_softmax_focalloss
 from module.loss import cosine_annealing, poly_annealing, linear_annealing
+from module.deploy import fold_bn
+from module.deploy import merge_pointwise
+from module.deploy import remove_dropout
 import simplecv.module as scm
 from configs.isaid.farseg50 import config as cfg
 
@@ -66,22 +69,38 @@ class SceneRelation(nn.Module):
                     nn.ReLU(True)
                 )
             )
+        # to_deploy后为合并的content_encoders和feature_reencoders
+        self.encoders = None
 
         self.normalizer = nn.Sigmoid()
 
+    def merge_encoders(self):
+        '''
+        将读取同一输入的content_encoders[i]和feature_reencoders[i]合并为一个输出通道数加倍的1x1卷积，
+        需要先折叠BatchNorm，见FarSeg.to_deploy。
+        '''
+        self.encoders = nn.ModuleList([merge_pointwise([c_en, f_en]) for c_en, f_en in
+                                       zip(self.content_encoders, self.feature_reencoders)])
+        del self.content_encoders, self.feature_reencoders
+        return self
+
     def forward(self, scene_feature, features: list):
-        content_feats = [c_en(p_feat) for c_en, p_feat in zip(self.content_encoders, features)]
+        if self.encoders is None:
+            content_feats = [c_en(p_feat) for c_en, p_feat in zip(self.content_encoders, features)]
+            p_feats = [op(p_feat) for op, p_feat in zip(self.feature_reencoders, features)]
+        else:
+            content_feats, p_feats = zip(*[op(p_feat).chunk(2, dim=1) for op, p_feat in zip(self.encoders, features)])
         if self.scale_aware_proj:
             scene_feats = [op(scene_feature) for op in self.scene_encoder]
-            relations = [self.normalizer((sf * cf).sum(dim=1, keepdim=True)) for sf, cf in
+            relations = [self.normalizer((sf.float() * cf.float()).sum(dim=1, keepdim=True)) for sf, cf in
                          zip(scene_feats, content_feats)]
         else:
             scene_feat = self.scene_encoder(scene_feature)
-            relations = [self.normalizer((scene_feat * cf).sum(dim=1, keepdim=True)) for cf in content_feats]
-
-        p_feats = [op(p_feat) for op, p_feat in zip(self.feature_reencoders, features)]
+            relations = [self.normalizer((scene_feat.float() * cf.float()).sum(dim=1, keepdim=True))
+                         for cf in content_feats]
 
-        refined_feats = [r * p for r, p in zip(relations, p_feats)]
+        # 关系图在fp32中计算（autocast下的点积求和与sigmoid），再转回特征的精度
+        refined_feats = [r.to(p.dtype) * p for r, p in zip(relations, p_feats)]
 
         return refined_feats
 
@@ -159,8 +178,12 @@ class FarSeg(CVModule):
         self.decoder = AssymetricDecoder(**self.config.decoder)
         self.cls_pred_conv = nn.Conv2d(self.config.decoder.out_channels, self.config.num_classes, 1)
         self.upsample4x_op = nn.UpsamplingBilinear2d(scale_factor=4)
+        # 推理时输出的步幅，为4时跳过最后的4倍上采样，由滑窗拼接在1/4分辨率上完成
+        self.infer_output_stride = 1
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-        if 'scene_relation' in self.config:
+        # 与配置有关的分支在构造时确定，forward中只读取普通属性，torch.compile不会因此中断计算图
+        self.use_scene_relation = 'scene_relation' in self.config
+        if self.use_scene_relation:
             print('scene_relation: on')
             self.gap = scm.GlobalAvgPool2D()
             self.sr = SceneRelation(**self.config.scene_relation)
@@ -174,6 +197,16 @@ class FarSeg(CVModule):
         if 'annealing_softmax_focalloss' in self.config:
             print('loss type: {}'.format(self.config.annealing_softmax_focalloss.annealing_type))
 
+        if 'softmax_focalloss' in self.config:
+            self.loss_type = 'softmax_focalloss'
+        elif 'annealing_softmax_focalloss' in self.config:
+            self.loss_type = 'annealing_softmax_focalloss'
+            self.annealing_fn = dict(cosine=cosine_annealing,
+                                     poly=poly_annealing,
+                                     linear=linear_annealing)[self.config.annealing_softmax_focalloss.annealing_type]
+        else:
+            self.loss_type = 'cross_entropy'
+
     def forward(self, x, y=None):
         '''
         前向传播方法，接受输入x和可选的标签y，返回预测结果或者训练损失。首先通过编码器获取特征列表，
@@ -181,19 +214,7 @@ class FarSeg(CVModule):
         之后，通过非对称解码器对特征列表进行解码，得到最终特征。将最终特征传入类别预测的卷积层，
         再进行4倍上采样，得到最终类别预测结果。如果处于训练状态，计算并返回损失值。
         '''
-        feat_list = self.en(x)
-        fpn_feat_list = self.fpn(feat_list)
-        if 'scene_relation' in self.config:
-            c5 = feat_list[-1]
-            c6 = self.gap(c5)
-            refined_fpn_feat_list = self.sr(c6, fpn_feat_list)
-        else:
-            refined_fpn_feat_list = fpn_feat_list
-
-        final_feat = self.decoder(refined_fpn_feat_list)
-        cls_pred = self.cls_pred_conv(final_feat)
-        cls_pred = self.upsample4x_op(cls_pred)
-
+        cls_pred = self._predict(self.forward_features(x))
         if self.training:
             cls_true = y['cls']
             loss_dict = dict()
@@ -205,7 +226,66 @@ class FarSeg(CVModule):
             loss_dict['mem'] = torch.from_numpy(np.array([mem], dtype=np.float32)).to(self.device)
             return loss_dict
 
-        return cls_pred.softmax(dim=1)
+        # softmax在fp32中计算，autocast下也是如此
+        return cls_pred.float().softmax(dim=1)
+
+    # forward_features返回的各特征的步幅，依次为FPN的四层和c5
+    feature_strides = (4, 8, 16, 32, 32)
+
+    def forward_features(self, x):
+        '''
+        编码器和FPN部分，只含局部的卷积运算，可以在比窗口大的图块上运行一次，再按窗口裁剪特征。
+        返回FPN的四层特征和c5。
+        '''
+        feat_list = self.en(x)
+        return list(self.fpn(feat_list)) + [feat_list[-1]]
+
+    def forward_head(self, features):
+        '''
+        推理时在每个窗口的特征上运行的部分，场景特征由窗口内的c5池化得到，与整窗前向一致。返回类别概率。
+        '''
+        return self._predict(features).float().softmax(dim=1)
+
+    def _predict(self, features):
+        fpn_feat_list, c5 = features[:-1], features[-1]
+        if self.use_scene_relation:
+            c6 = self.gap(c5)
+            refined_fpn_feat_list = self.sr(c6, fpn_feat_list)
+        else:
+            refined_fpn_feat_list = fpn_feat_list
+
+        final_feat = self.decoder(refined_fpn_feat_list)
+        cls_pred = self.cls_pred_conv(final_feat)
+        if self.training or self.infer_output_stride == 1:
+            cls_pred = self.upsample4x_op(cls_pred)
+        return cls_pred
+
+    def to_deploy(self):
+        '''
+        原地转换为推理用的模型：卷积后的BatchNorm折叠进卷积，场景关系模块中读取同一输入的两个1x1卷积合并，
+        去掉dropout。输出与eval模式一致（浮点误差内），转换后不能再训练。
+        '''
+        self.eval()
+        fold_bn(self)
+        remove_dropout(self)
+        if self.use_scene_relation:
+            self.sr.merge_encoders()
+        return self
+
+    def set_infer_output_stride(self, output_stride):
+        """ 1: full resolution probabilities, 4: stride 4 probabilities without the final upsampling.
+        """
+        if output_stride not in (1, 4):
+            raise ValueError('output_stride should be 1 or 4, got {}.'.format(output_stride))
+        self.infer_output_stride = output_stride
+        return self
+
+    def set_memory_format(self, memory_format):
+        '''
+        torch.channels_last: 权重转换为NHWC，卷积在NHWC下运行，输入也应为channels last（见SegmSlidingWinInference）。
+        '''
+        self.to(memory_format=memory_format)
+        return self
 
     def cls_loss(self, y_pred, y_true):
         '''
@@ -215,20 +295,18 @@ class FarSeg(CVModule):
         :param y_true:
         :return:
         '''
-        if 'softmax_focalloss' in self.config:
+        if self.loss_type == 'softmax_focalloss':
             return softmax_focalloss(y_pred, y_true.long(), ignore_index=self.config.loss.ignore_index,
                                      gamma=self.config.softmax_focalloss.gamma,
                                      normalize=self.config.softmax_focalloss.normalize)
-        elif 'annealing_softmax_focalloss' in self.config:
-            func_dict = dict(cosine=cosine_annealing,
-                             poly=poly_annealing,
-                             linear=linear_annealing)
+        elif self.loss_type == 'annealing_softmax_focalloss':
+            # 训练步数以张量传入，不调用.item()，避免主机同步
             return annealing_softmax_focalloss(y_pred, y_true.long(),
-                                               self.buffer_step.item(),
+                                               self.buffer_step,
                                                self.config.annealing_softmax_focalloss.max_step,
                                                self.config.loss.ignore_index,
                                                self.config.annealing_softmax_focalloss.gamma,
-                                               func_dict[self.config.annealing_softmax_focalloss.annealing_type])
+                                               self.annealing_fn)
         return F.cross_entropy(y_pred, y_true.long(), ignore_index=self.config.loss.ignore_index)
 
     def set_defalut_config(self):
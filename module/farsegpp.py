@@ -7,6 +7,9 @@ from ever.module import FPN, AssymetricDecoder
 import torch.nn.functional as F
 from ever.module import ResNetEncoder
 from comm import MultiSegmentation
+from module.deploy import fold_bn
+from module.deploy import merge_pointwise
+from module.deploy import remove_dropout
 
 
 class FSRelation(nn.Module):
@@ -72,24 +75,39 @@ class FSRelation(nn.Module):
                     nn.ReLU(True)
                 )
             )
+        # merged content_encoders and feature_reencoders after merge_encoders
+        self.encoders = None
 
         self.normalizer = nn.Sigmoid()
 
+    def merge_encoders(self):
+        """ merge content_encoders[i] and feature_reencoders[i], which read the same input, into one
+        conv with twice the output channels. Their BatchNorm2d must be folded already, see to_deploy.
+        """
+        self.encoders = nn.ModuleList([merge_pointwise([c_en, f_en]) for c_en, f_en in
+                                       zip(self.content_encoders, self.feature_reencoders)])
+        del self.content_encoders, self.feature_reencoders
+        return self
+
     def forward(self, scene_feature, features: list):
         # [N, C, H, W]
-        content_feats = [c_en(p_feat) for c_en, p_feat in zip(self.content_encoders, features)]
+        if self.encoders is None:
+            content_feats = [c_en(p_feat) for c_en, p_feat in zip(self.content_encoders, features)]
+            p_feats = [op(p_feat) for op, p_feat in zip(self.feature_reencoders, features)]
+        else:
+            content_feats, p_feats = zip(*[op(p_feat).chunk(2, dim=1) for op, p_feat in zip(self.encoders, features)])
         if self.scale_aware_proj:
             scene_feats = [op(scene_feature) for op in self.scene_encoder]
-            relations = [self.normalizer((sf * cf).sum(dim=1, keepdim=True)) for sf, cf in
+            relations = [self.normalizer((sf.float() * cf.float()).sum(dim=1, keepdim=True)) for sf, cf in
                          zip(scene_feats, content_feats)]
         else:
             # [N, C, 1, 1]
             scene_feat = self.scene_encoder(scene_feature)
-            relations = [self.normalizer((scene_feat * cf).sum(dim=1, keepdim=True)) for cf in content_feats]
-
-        p_feats = [op(p_feat) for op, p_feat in zip(self.feature_reencoders, features)]
+            relations = [self.normalizer((scene_feat.float() * cf.float()).sum(dim=1, keepdim=True))
+                         for cf in content_feats]
 
-        refined_feats = [torch.cat([r * p, o], dim=1) for r, p, o in zip(relations, p_feats, features)]
+        # relations are computed in fp32 under autocast and cast back to the feature precision
+        refined_feats = [torch.cat([r.to(p.dtype) * p, o], dim=1) for r, p, o in zip(relations, p_feats, features)]
 
         if self.scale_aware_proj:
             ffeats = [op(x) for op, x in zip(self.project, refined_feats)]
@@ -147,6 +165,9 @@ class ResolutionAlign(nn.Module):
 
 
 class Decoder(AssymetricDecoder):
+    # False: skip the upsampling layers of the classifier at inference
+    upsample = True
+
     def forward(self, feat_list: list):
         inner_feat_list = []
         for idx, block in enumerate(self.blocks):
@@ -156,10 +177,21 @@ class Decoder(AssymetricDecoder):
         out_feat = sum(inner_feat_list) / len(inner_feat_list)
         if self.cls_cfg:
             logit = self.dropout(out_feat)
-            logit = self.classifier(logit)
+            if self.upsample or self.training or not isinstance(self.classifier, nn.Sequential):
+                logit = self.classifier(logit)
+            else:
+                for m in self.classifier:
+                    if not isinstance(m, (nn.Upsample, nn.UpsamplingBilinear2d)):
+                        logit = m(logit)
         return logit, out_feat
 
 
+def _objectness_keep(obj_logit, threshold):
+    # [N] max objectness of each window, on the host for the exit statistics
+    max_obj = obj_logit.flatten(1).amax(dim=1).float().sigmoid()
+    return max_obj >= threshold, max_obj.cpu()
+
+
 class ParallelDecoder(nn.Module):
     def __init__(self, obj_cfg, seg_cfg):
         super().__init__()
@@ -174,6 +206,19 @@ class ParallelDecoder(nn.Module):
         seg_logit, _ = self.seg_decoder(features)
         return obj_logit, seg_logit
 
+    def forward_early_exit(self, features, threshold):
+        """ objectness first, the semantic decoder only runs on the windows that may contain objects.
+
+        Returns:
+            [N] keep mask, [N] max objectness, seg_logit of the kept windows or None
+        """
+        obj_logit, _ = self.obj_decoder(features)
+        keep, max_obj = _objectness_keep(obj_logit, threshold)
+        seg_logit = None
+        if bool(max_obj.max() >= threshold):
+            seg_logit, _ = self.seg_decoder([f[keep] for f in features])
+        return keep, max_obj, seg_logit
+
 
 class SegObjCascadeDecoder(nn.Module):
     def __init__(self, obj_cfg, seg_cfg):
@@ -208,6 +253,16 @@ class ObjSegCascadeDecoder(nn.Module):
         seg_logit, _ = self.seg_decoder([self.conv(obj_feature)] + features)
         return obj_logit, seg_logit
 
+    def forward_early_exit(self, features, threshold):
+        """ see ParallelDecoder.forward_early_exit, the objectness decoder already comes first here.
+        """
+        obj_logit, obj_feature = self.obj_decoder(features)
+        keep, max_obj = _objectness_keep(obj_logit, threshold)
+        seg_logit = None
+        if bool(max_obj.max() >= threshold):
+            seg_logit, _ = self.seg_decoder([self.conv(obj_feature[keep])] + [f[keep] for f in features])
+        return keep, max_obj, seg_logit
+
 
 @er.registry.MODEL.register('FarSegPP')
 class FarSegPP(er.ERModule, MultiSegmentation):
@@ -240,9 +295,106 @@ class FarSegPP(er.ERModule, MultiSegmentation):
                 self.config.asy_decoder
             )
         self.register_buffer('buffer_step', torch.zeros((), dtype=torch.float32))
+        # decided once here, forward only reads plain attributes and does not break a torch.compile graph
+        self.use_obj_logit = getattr(self.decoder, 'use_obj_logit', False)
+        self.infer_output_stride = 1
+        # None: always run the semantic decoder at inference
+        self.early_exit_threshold = None
+        self.reset_exit_stats()
+
+    def to_deploy(self):
+        """ convert in place for inference: BatchNorm2d after a conv is folded into it, the two 1x1 convs of
+        FSRelation that read the same input are merged and dropout is removed. Outputs match eval mode up
+        to float rounding, the converted model cannot be trained.
+        """
+        self.eval()
+        fold_bn(self)
+        remove_dropout(self)
+        self.fsr.merge_encoders()
+        return self
+
+    def set_infer_output_stride(self, output_stride):
+        """ 1: full resolution output, 4: stride 4 output without the classifier upsampling.
+        """
+        if output_stride not in (1, 4):
+            raise ValueError('output_stride should be 1 or 4, got {}.'.format(output_stride))
+        self.infer_output_stride = output_stride
+        for m in self.modules():
+            if isinstance(m, Decoder):
+                m.upsample = output_stride == 1
+        return self
+
+    def set_memory_format(self, memory_format):
+        """ torch.channels_last: the weights are converted and the convs run in NHWC, the inputs should be
+        channels last as well (see SegmSlidingWinInference). The MiT stage outputs follow the same layout.
+        """
+        self.to(memory_format=memory_format)
+        for m in self.modules():
+            if hasattr(m, 'memory_format'):
+                m.memory_format = memory_format
+        return self
+
+    def set_early_exit(self, threshold):
+        """ windows whose max objectness is below threshold skip the semantic decoder and are background.
+        None disables the early exit. The objectness decoder must not depend on the semantic one.
+        """
+        if threshold is not None and not hasattr(self.decoder, 'forward_early_exit'):
+            raise ValueError('early exit needs the objectness decoder first, {} runs it after the semantic '
+                             'decoder.'.format(self.config.decoder_arch))
+        self.early_exit_threshold = threshold
+        return self
+
+    def reset_exit_stats(self, num_bins=10):
+        # histogram of the max objectness per window, to choose the threshold
+        self.exit_stats = dict(windows=0, exited=0, max_objectness_hist=[0] * num_bins)
+
+    def _update_exit_stats(self, keep, max_obj):
+        stats = self.exit_stats
+        num_bins = len(stats['max_objectness_hist'])
+        stats['windows'] += keep.numel()
+        stats['exited'] += keep.numel() - int(keep.sum())
+        for b in (max_obj * num_bins).long().clamp_(max=num_bins - 1).tolist():
+            stats['max_objectness_hist'][b] += 1
+
+    def forward_early_exit(self, refined_fpn_feature_list):
+        keep, max_obj, seg_logit = self.decoder.forward_early_exit(refined_fpn_feature_list,
+                                                                   self.early_exit_threshold)
+        self._update_exit_stats(keep, max_obj)
+        n = keep.size(0)
+        # the output has the size of the semantic branch, early-exited windows are background
+        h, w = refined_fpn_feature_list[0].shape[2:4]
+        if self.infer_output_stride == 1:
+            h, w = h * 4, w * 4
+        num_classes = self.config.asy_decoder.classifier_config.num_classes
+        prob = refined_fpn_feature_list[0].new_zeros((n, num_classes, h, w), dtype=torch.float32)
+        prob[:, 0] = 1.
+        if seg_logit is not None:
+            prob[keep] = seg_logit.float().softmax(dim=1)
+        return prob
+
+    # strides of the encoder features returned by forward_features
+    feature_strides = (4, 8, 16, 32)
+
+    def forward_features(self, x):
+        """ the encoder, can run once on a tile larger than a window whose features are then cropped per window.
+        The MiT encoder attends over the whole input, its tile features differ more from the window ones.
+        """
+        return self.en(x)
+
+    def forward_head(self, features):
+        """ inference on the encoder features of a window, the ppm and the scene embedding see only the window.
+        """
+        refined_fpn_feature_list = self._refine(features)
+        if self.early_exit_threshold is not None:
+            return self.forward_early_exit(refined_fpn_feature_list)
+        obj_logit, seg_logit = self.decoder(refined_fpn_feature_list)
+        if self.use_obj_logit:
+            return obj_logit.float().sigmoid()
+        # the output probabilities are computed in fp32, also under autocast
+        return seg_logit.float().softmax(dim=1)
 
-    def forward(self, x, y=None):
-        feature_list = self.en(x)
+    def _refine(self, feature_list):
+        feature_list = list(feature_list)
         last_feat = feature_list[-1]
         # ppm
         feature_list[-1] = self.ppm(feature_list[-1])
@@ -250,24 +402,25 @@ class FarSegPP(er.ERModule, MultiSegmentation):
         fpn_feature_list = self.fpn(feature_list)
         # fsr
         scene_embedding = F.adaptive_avg_pool2d(last_feat, 1)
-        refined_fpn_feature_list = self.fsr(scene_embedding, fpn_feature_list)
-        # decode
-        obj_logit, seg_logit = self.decoder(refined_fpn_feature_list)
+        return self.fsr(scene_embedding, fpn_feature_list)
 
-        if self.training:
-            loss_dict = dict()
-            gt_seg = y['cls']
-            gt_binary_seg = torch.where(((gt_seg > 0) & (gt_seg != self.config.loss.objectness.ignore_index)),
-                                        torch.ones_like(gt_seg),
-                                        gt_seg).float()
-            loss_dict.update(self.loss(gt_binary_seg, obj_logit, self.config.loss.objectness))
-            self.buffer_step += 1.
-            loss_dict.update(self.loss(gt_seg, seg_logit, self.config.loss.semantic, buffer_step=self.buffer_step))
-
-            return loss_dict
-        if hasattr(self.decoder, 'use_obj_logit') and self.decoder.use_obj_logit:
-            return obj_logit.sigmoid()
-        return seg_logit.softmax(dim=1)
+    def forward(self, x, y=None):
+        feature_list = self.forward_features(x)
+        if not self.training:
+            return self.forward_head(feature_list)
+        # decode
+        obj_logit, seg_logit = self.decoder(self._refine(feature_list))
+
+        loss_dict = dict()
+        gt_seg = y['cls']
+        gt_binary_seg = torch.where(((gt_seg > 0) & (gt_seg != self.config.loss.objectness.ignore_index)),
+                                    torch.ones_like(gt_seg),
+                                    gt_seg).float()
+        loss_dict.update(self.loss(gt_binary_seg, obj_logit, self.config.loss.objectness))
+        self.buffer_step += 1.
+        loss_dict.update(self.loss(gt_seg, seg_logit, self.config.loss.semantic, buffer_step=self.buffer_step))
+
+        return loss_dict
 
     def set_default_config(self):
         self.config.update(dict(
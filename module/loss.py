@@ -30,7 +30,8 @@ def softmax_focalloss(y_pred, y_true, ignore_index=255, gamma=2.0, normalize=Fal
 
 
 def cosine_annealing(lower_bound, upper_bound, _t, _t_max):
-    return upper_bound + 0.5 * (lower_bound - upper_bound) * (math.cos(math.pi * _t / _t_max) + 1)
+    # _t may be a tensor on the device, torch.cos keeps it there
+    return upper_bound + 0.5 * (lower_bound - upper_bound) * (torch.cos(math.pi * torch.as_tensor(_t) / _t_max) + 1)
 
 
 def poly_annealing(lower_bound, upper_bound, _t, _t_max):
@@ -54,9 +55,8 @@ def annealing_softmax_focalloss(y_pred, y_true, t, t_max, ignore_index=255, gamm
         modulating_factor = torch.gather(modulating_factor, dim=1, index=masked_y_true.unsqueeze(dim=1)).squeeze_(dim=1)
         normalizer = losses.sum() / (losses * modulating_factor).sum()
         scales = modulating_factor * normalizer
-    if t > t_max:
-        scale = scales
-    else:
-        scale = annealing_function(1, scales, t, t_max)
+    # every annealing function reaches scales at t_max, clamping the step replaces the branch on its value,
+    # so a step tensor needs neither .item() nor a host sync
+    scale = annealing_function(1, scales, torch.as_tensor(t).clamp(max=t_max), t_max)
     losses = (losses * scale).sum() / (valid_mask.sum() + p.size(0))
     return losses
@@ -0,0 +1,79 @@
+import argparse
+import logging
+
+import numpy as np
+import torch
+import simplecv as sc
+from simplecv.api.preprocess import comm
+from simplecv.api.preprocess import segm
+from torch.utils.data import DataLoader
+from torch.utils.data import Subset
+from data.isaid import ISAIDSegmmDataset
+from data.isaid import RemoveColorMap
+from module import farseg
+from infer.quant import quantize_static
+from infer.quant import save_quantized
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--config_path', default=None, type=str,
+                    help='path to config file')
+parser.add_argument('--ckpt_path', default=None, type=str,
+                    help='path to model file')
+parser.add_argument('--image_dir', default=None, type=str,
+                    help='path to the training image dir, calibration patches are sampled from it')
+parser.add_argument('--mask_dir', default=None, type=str,
+                    help='path to the training mask dir')
+parser.add_argument('--out_path', default=None, type=str,
+                    help='quantized TorchScript model, evaluated with isaid_eval.py --quantized')
+parser.add_argument('--num_calib', default=64, type=int,
+                    help='number of calibration patches')
+parser.add_argument('--batch_size', default=4, type=int,
+                    help='calibration batch size')
+parser.add_argument('--patch_size', default=896, type=int,
+                    help='patch size')
+parser.add_argument('--output_stride', default=1, type=int, choices=(1, 4),
+                    help='output stride frozen into the quantized model, isaid_eval.py must use the same')
+parser.add_argument('--backend', default='x86', type=str, choices=('x86', 'fbgemm', 'qnnpack'),
+                    help='quantized engine of the target cpus')
+parser.add_argument('--seed', default=0, type=int,
+                    help='seed of the calibration sample')
+args = parser.parse_args()
+
+logger = logging.getLogger('SW-Infer')
+logger.setLevel(logging.INFO)
+
+
+def calib_loader():
+    """ random training patches, padded to the patch size and normalized like in isaid_eval.
+    """
+    dataset = ISAIDSegmmDataset(args.image_dir, args.mask_dir,
+                                patch_config=dict(patch_size=args.patch_size, stride=512),
+                                transforms=[
+                                    RemoveColorMap(),
+                                    segm.FixedPad((args.patch_size, args.patch_size), 255),
+                                    segm.ToTensor(True),
+                                    comm.THMeanStdNormalize((123.675, 116.28, 103.53), (58.395, 57.12, 57.375))
+                                ])
+    indices = np.random.RandomState(args.seed).permutation(len(dataset))[:args.num_calib]
+    loader = DataLoader(Subset(dataset, indices.tolist()), batch_size=args.batch_size, num_workers=2)
+    for images, _ in loader:
+        yield images
+
+
+def run():
+    model, global_step = sc.infer_tool.build_and_load_from_file(args.config_path, args.ckpt_path)
+    model.cpu()
+    model.eval()
+    if args.output_stride > 1:
+        model.set_infer_output_stride(args.output_stride)
+    # 编码器、FPN、场景关系模块和解码器量化为int8，分类卷积和softmax保持fp32
+    qmodel = quantize_static(model, calib_loader(), backend=args.backend)
+    example = torch.zeros(1, 3, args.patch_size, args.patch_size)
+    save_quantized(args.out_path, qmodel, example, config_path=args.config_path, global_step=int(global_step),
+                   output_stride=args.output_stride, backend=args.backend)
+    logger.info('quantized model saved to {}'.format(args.out_path))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,47 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from module.deploy import fold_bn
+
+
+def _randomize_bn(model):
+    torch.manual_seed(0)
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+def _batchnorms(model):
+    return [name for name, m in model.named_modules() if isinstance(m, nn.BatchNorm2d)]
+
+
+def test_fold_bn_torchvision_resnet():
+    models = pytest.importorskip('torchvision.models')
+    for arch in (models.resnet18, models.resnet50):
+        model = _randomize_bn(arch())
+        x = torch.randn(2, 3, 64, 64)
+        with torch.no_grad():
+            ref = model(x)
+            fold_bn(model)
+            out = model(x)
+        assert _batchnorms(model) == []
+        assert torch.allclose(out, ref, rtol=1e-4, atol=1e-4)
+
+
+def test_farseg_to_deploy_resnet_encoder():
+    pytest.importorskip('simplecv')
+    from module.farseg import FarSeg
+
+    model = _randomize_bn(FarSeg(dict()))
+    x = torch.randn(1, 3, 128, 128)
+    with torch.no_grad():
+        ref = model(x)
+        model.to_deploy()
+        out = model(x)
+    assert _batchnorms(model.en) == []
+    assert torch.allclose(out, ref, atol=1e-5)
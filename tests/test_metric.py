@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+import torch
+
+from infer.metric import ConfusionMatrix
+
+
+def test_summary_writes_iou_table(tmp_path):
+    miou_op = ConfusionMatrix(num_classes=3)
+    y_true = torch.tensor([[0, 1, 2, 255], [0, 1, 2, 2]])
+    y_pred = torch.tensor([[0, 1, 1, 0], [0, 1, 2, 2]], dtype=torch.uint8)
+    miou_op.forward(y_true, y_pred)
+    log_dir = os.path.join(str(tmp_path), 'log')
+    ious, miou = miou_op.summary(class_names=['background', 'a', 'b'], log_dir=log_dir)
+
+    with open(os.path.join(log_dir, 'miou.txt')) as f:
+        lines = f.read().splitlines()
+    assert lines[0].split() == ['class', 'iou']
+    assert [line.split()[0] for line in lines[1:]] == ['background', 'a', 'b', 'mIoU']
+    assert np.allclose([float(line.split()[1]) for line in lines[1:4]], ious, atol=1e-5)
+    assert abs(float(lines[-1].split()[1]) - miou) < 1e-5
+
+
+def test_summary_without_log_dir_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    miou_op = ConfusionMatrix(num_classes=2)
+    miou_op.forward(torch.tensor([0, 1]), torch.tensor([0, 1]))
+    miou_op.summary()
+    assert os.listdir(str(tmp_path)) == []
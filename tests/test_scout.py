@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+pytest.importorskip('simplecv')
+
+from infer.sliding_win import SegmSlidingWinInference
+from infer.stitch import build_accumulator
+
+
+@pytest.mark.parametrize('output_mode, output_stride', [('float32', 1), ('float32', 4), ('uint8', 1)])
+def test_skipped_window_votes_for_background(output_mode, output_stride):
+    # two 64x64 windows overlapping on 32 columns, the second one is skipped by the scout pass
+    helper = SegmSlidingWinInference(output_stride=output_stride)
+    wins = torch.tensor([[0, 0, 64, 64], [32, 0, 96, 64]]).numpy()
+    acc = build_accumulator(output_mode, 64, 96, wins, output_stride=output_stride)
+    s = output_stride
+    torch.manual_seed(0)
+    pred = torch.randn(1, 4, 64 // s, 64 // s).softmax(dim=1)
+    # the uint8 accumulator scales its input in place
+    acc.add(pred.clone(), wins[0])
+    background = helper.background_output(wins[1], 4)
+    assert background.shape == pred.shape
+    acc.add(background, wins[1])
+    out = acc.result().float()
+    if output_mode == 'uint8':
+        out = out / 255.
+
+    atol = 2. * 2 / 255. if output_mode == 'uint8' else 1e-6
+    assert torch.allclose(out.sum(dim=1), torch.ones(1, 64 // s, 96 // s), atol=atol)
+    one_hot = torch.zeros(4)
+    one_hot[0] = 1.
+    overlap = out[0, :, :, 32 // s:64 // s]
+    assert torch.allclose(overlap, (pred[0, :, :, 32 // s:] + one_hot[:, None, None]) / 2., atol=atol)
+    assert torch.allclose(out[0, :, :, 64 // s:], one_hot[:, None, None].expand(-1, 64 // s, 32 // s), atol=atol)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+pytest.importorskip('simplecv')
+
+from infer.sliding_win import SegmSlidingWinInference
+from infer.stitch import build_accumulator
+
+
+class ToyModel(nn.Module):
+    """ four strided conv stages and a per-window head with a global context vector, like FarSeg.
+    """
+    feature_strides = (4, 8, 16, 32)
+
+    def __init__(self, num_classes=4):
+        super(ToyModel, self).__init__()
+        channels = (3, 8, 16, 16, 16)
+        self.stages = nn.ModuleList([nn.Sequential(nn.Conv2d(channels[i], channels[i + 1], 3, 4 if i == 0 else 2, 1),
+                                                   nn.ReLU(True)) for i in range(4)])
+        self.cls = nn.ModuleList([nn.Conv2d(c, num_classes, 1) for c in channels[1:]])
+
+    def forward_features(self, x):
+        features = []
+        for stage in self.stages:
+            x = stage(x)
+            features.append(x)
+        return features
+
+    def forward_head(self, features):
+        out = 0.
+        for f, cls in zip(features, self.cls):
+            y = cls(f) + cls(f.mean(dim=(2, 3), keepdim=True))
+            out = out + F.interpolate(y, size=features[0].shape[2:], mode='bilinear', align_corners=False)
+        return F.interpolate(out, scale_factor=4, mode='bilinear', align_corners=False).softmax(dim=1)
+
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
+
+
+def _scene_outputs(model, shared_tile, shared_halo, shared=True):
+    torch.manual_seed(0)
+    image = np.random.RandomState(0).rand(300, 420, 3).astype(np.float32)
+    helper = SegmSlidingWinInference(batch_size=3, shared_tile=shared_tile, shared_halo=shared_halo)
+    helper.device = torch.device('cpu')
+    helper.transforms = None
+    wins = helper.make_wins((300, 420), (128, 128), 96)
+    scene = helper.prepare_scene(image)
+    acc = build_accumulator('float32', 300, 420, wins)
+    iter_outputs = helper.iter_outputs_shared if shared else helper.iter_outputs
+    for pred, win in iter_outputs(model, scene, wins, size_divisor=32):
+        acc.add(pred, win)
+    return acc.result()
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return ToyModel().eval()
+
+
+def test_tile_equal_to_window_matches_windowed_inference(model):
+    ref = _scene_outputs(model, 128, 0, shared=False)
+    out = _scene_outputs(model, 128, 0)
+    assert torch.allclose(out, ref, atol=1e-5)
+
+
+def test_large_tiles_label_agreement(model):
+    ref = _scene_outputs(model, 128, 0, shared=False)
+    out = _scene_outputs(model, 512, 64)
+    agreement = (out.argmax(dim=1) == ref.argmax(dim=1)).float().mean().item()
+    assert agreement >= 0.99